@@ -0,0 +1,312 @@
+""" CPU benchmarks of the model, dataset, sampler and validation hot paths
+
+    python benchmarks/bench.py run --output baseline.json   # on the reference commit
+    python benchmarks/bench.py run --output bench.json
+    python benchmarks/bench.py compare bench.json baseline.json --threshold 0.15
+    python benchmarks/bench.py precision train_config_vit.json --precisions fp32 bf16-cpu
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+from datetime import datetime
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import model as models
+import data_utils
+from utils import load_config, fix_seed
+from data_utils import CustomDataset, StreamingDataset, build_dataloader
+from train import evaluate
+from precision import Precision
+from synthetic import write_dataset
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def arg_parse():
+    """
+    parse arguments from a command
+    """
+    parser = argparse.ArgumentParser()
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    run = sub.add_parser('run', help='run the benchmarks and write a JSON report')
+    run.add_argument('--output', type=str, default='bench.json')
+    run.add_argument('--configs', nargs='+', default=['train_config_vit.json', 'train_config_oncf.json'],
+                     help='configs whose model args and batch sizes are benchmarked')
+    run.add_argument('--scales', nargs='+', type=float, default=[0.1, 1.0],
+                     help='dataset sizes as a fraction of MovieLens-1M (1M interactions)')
+    run.add_argument('--repeat', type=int, default=5)
+    run.add_argument('--filter', type=str, default='', help='only run benchmarks whose name contains this')
+
+    precision = sub.add_parser('precision', help='train a config at each precision, report throughput and HR/NDCG deltas')
+    precision.add_argument('config', type=str)
+    precision.add_argument('--precisions', nargs='+', default=['fp32', 'bf16-cpu'],
+                           help='precisions trained, deltas are against the first one')
+    precision.add_argument('--epochs', type=int, default=None, help='override num_epochs of the config')
+    precision.add_argument('--output', type=str, default='precision.json')
+
+    compare = sub.add_parser('compare', help='flag regressions against a stored baseline')
+    compare.add_argument('current', type=str)
+    compare.add_argument('baseline', type=str)
+    compare.add_argument('--threshold', type=float, default=0.1, help='allowed relative slowdown')
+    return parser.parse_args()
+
+
+def timeit(fn, repeat = 5, warmup = 1, number = 1):
+    """ Median/min/max seconds per call of fn over repeat rounds of number calls """
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        times.append((time.perf_counter() - start) / number)
+    return {'median': float(np.median(times)), 'min': float(np.min(times)), 'max': float(np.max(times)),
+            'repeat': repeat, 'number': number}
+
+
+class Runner:
+    def __init__(self, repeat, name_filter):
+        self.repeat = repeat
+        self.name_filter = name_filter
+        self.results = {}
+
+    def __call__(self, name, fn, warmup = 1, number = 1, repeat = None, **extra):
+        if self.name_filter not in name:
+            return
+        result = timeit(fn, repeat or self.repeat, warmup, number)
+        result.update(extra)
+        self.results[name] = result
+        print(f"{name:<56}{result['median'] * 1e3:>12.3f} ms")
+
+
+def bench_model(run, cfgs, tag):
+    """ Forward/backward of a training step and an eval forward of the configured model """
+    args = cfgs.model.args._asdict()
+    model = getattr(models, cfgs.model.name)(**args)
+    optimizer = torch.optim.Adam(model.parameters(), lr = 1e-3)
+    batch_size = cfgs.train_dataloader.args.batch_size
+    user = torch.randint(args['user_num'], (batch_size, 1))
+    item = torch.randint(args['item_num'], (batch_size, 1))
+    neg_item = torch.randint(args['item_num'], (batch_size, 1))
+
+    def step(precision):
+        optimizer.zero_grad()
+        with precision.autocast():
+            if cfgs.model.name == 'ONCF':
+                pos, neg = model.score_pairs(user, item, neg_item)
+            else:
+                main = model(user, item)['main']
+        loss = (pos - neg).sum() if cfgs.model.name == 'ONCF' else main.sum()
+        precision.backward(loss)
+        precision.step(optimizer)
+
+    model.train()
+    for name in ('fp32', 'bf16-cpu'):
+        precision = Precision(name)
+        suffix = '' if name == 'fp32' else f'/{name}'
+        run(f'model/{tag}/train_step/b{batch_size}{suffix}', lambda: step(precision), number = 10, batch_size = batch_size)
+
+    model.eval()
+    eval_size = cfgs.val_dataloader.args.batch_size
+    user = torch.randint(args['user_num'], (eval_size, 1))
+    item = torch.randint(args['item_num'], (eval_size, 1))
+    with torch.no_grad():
+        if cfgs.model.name == 'ONCF':
+            run(f'model/{tag}/eval_forward/b{eval_size}', lambda: model(user, item, False))
+        else:
+            run(f'model/{tag}/eval_forward/b{eval_size}', lambda: model(user, item))
+    return model
+
+
+def bench_data(run, cfgs, scale, work_dir, trained_models):
+    """ Dataset build, negative sampling, item access and a validation pass at one scale """
+    user_num, item_num = cfgs.model.args.user_num, cfgs.model.args.item_num
+    num_interactions = int(scale * 1_000_000)
+    paths = write_dataset(os.path.join(work_dir, f's{scale}'), user_num, item_num, num_interactions)
+    num_ng = cfgs.train_dataset.args.num_ng or 4
+    tag = f's{scale}'
+
+    def build_cold():
+        shutil.rmtree(os.path.join(os.path.dirname(paths['data_path_main_train']), '.cache'), ignore_errors=True)
+        data_utils._loaded.clear()
+        return CustomDataset(**paths, num_ng=num_ng, is_training=True)
+
+    def build_warm():
+        data_utils._loaded.clear()
+        return CustomDataset(**paths, num_ng=num_ng, is_training=True)
+
+    run(f'dataset/{tag}/build_cold', build_cold, warmup = 0, repeat = min(run.repeat, 3), interactions = num_interactions)
+    run(f'dataset/{tag}/build_warm', build_warm, interactions = num_interactions)
+
+    fix_seed(0)
+    dataset = CustomDataset(**paths, num_ng=num_ng, is_training=True)
+    run(f'sampler/{tag}/ng_sample/ng{num_ng}', dataset.ng_sample, samples = num_interactions * num_ng)
+
+    dataset.ng_sample()
+    n = min(len(dataset), 20000)
+    idx = np.random.default_rng(0).integers(len(dataset), size=n)
+    run(f'dataset/{tag}/getitem/{n}', lambda: [dataset[int(i)] for i in idx], warmup = 0, samples = n)
+    batch_size = cfgs.train_dataloader.args.batch_size
+    loader = build_dataloader(dataset, batch_size=batch_size, shuffle=True, drop_last=True)
+    run(f'dataset/{tag}/epoch_iter/b{batch_size}', lambda: sum(1 for _ in loader), warmup = 0,
+        repeat = min(run.repeat, 3), samples = len(dataset))
+
+    stream = StreamingDataset(**paths, num_ng=num_ng)
+    loader = build_dataloader(stream, batch_size=batch_size, shuffle=True, drop_last=True)
+    run(f'dataset/{tag}/stream_epoch/b{batch_size}', lambda: sum(1 for _ in loader), warmup = 0,
+        repeat = min(run.repeat, 3), samples = len(dataset))
+
+    val_dataset = CustomDataset(**paths, num_ng=0, is_training=False)
+    num_users = 500
+    # whole candidate lists of the first users, batched by get_batch as in validation
+    val_dataset.select(np.arange(num_users * val_dataset.num_candidates))
+    for name, model in trained_models.items():
+        loader = build_dataloader(val_dataset, batch_size=cfgs.val_dataloader.args.batch_size)
+        run(f'validation/{tag}/{name}/{num_users}users', lambda: evaluate(model, loader, [10], 'cpu'),
+            repeat = min(run.repeat, 3), users = num_users)
+
+
+def run_benchmarks(args):
+    torch.manual_seed(0)
+    run = Runner(args.repeat, args.filter)
+    cfgs = [load_config(os.path.join(ROOT, c) if not os.path.exists(c) else c) for c in args.configs]
+
+    trained_models = {}
+    for cfg in cfgs:
+        tag = cfg.model.name
+        trained_models[tag] = bench_model(run, cfg, tag)
+
+    work_dir = tempfile.mkdtemp(prefix='bench_')
+    try:
+        for scale in args.scales:
+            bench_data(run, cfgs[0], scale, work_dir, trained_models)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {'meta': {'date': datetime.now().isoformat(timespec='seconds'),
+                       'torch': torch.__version__,
+                       'numpy': np.__version__,
+                       'python': platform.python_version(),
+                       'platform': platform.platform(),
+                       'processor': platform.processor(),
+                       'cpu_count': os.cpu_count(),
+                       'torch_threads': torch.get_num_threads()},
+              'results': run.results}
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'wrote {len(run.results)} results to {args.output}')
+
+
+def bench_precision(args):
+    """Train a config once per precision and compare training throughput and HR/NDCG
+
+    Every precision starts from the same seed and the same datasets. Throughput
+    is samples per second of the training phases recorded by the profiler
+    (validation excluded), averaged over epochs.
+    """
+    from train import run as train_run, build_datasets
+
+    with open(args.config, 'r') as f:
+        base = json.load(f)
+    work_dir = tempfile.mkdtemp(prefix='bench_precision_')
+    datasets = None
+    report = {}
+    try:
+        for name in args.precisions:
+            cfg = json.loads(json.dumps(base))
+            cfg.update(precision = name, saved_dir = work_dir, run_name = name,
+                       distributed = {'world_size': 1, 'backend': 'gloo'},
+                       profile = {'enabled': True, 'trace_steps': 0})
+            if args.epochs:
+                cfg['num_epochs'] = args.epochs
+            cfg['val_every'] = min(cfg['val_every'], cfg['num_epochs'])
+            cfg_path = os.path.join(work_dir, f'{name}.json')
+            with open(cfg_path, 'w') as f:
+                json.dump(cfg, f, indent=2)
+
+            fix_seed(cfg['seed'])
+            datasets = datasets or build_datasets(load_config(cfg_path))
+            fix_seed(cfg['seed'])
+            result = train_run(cfg_path, datasets = datasets)
+            with open(os.path.join(result['saved_dir'], 'metrics.jsonl'), 'r') as f:
+                epochs = [json.loads(line) for line in f]
+            samples = sum(e['samples'] for e in epochs)
+            seconds = sum(e['wall_time'] - e['phases'].get('validation', 0.) for e in epochs)
+            report[name] = {'samples_per_sec': samples / seconds, 'hr': result['best_hr'],
+                            'ndcg': result['best_ndcg'], 'epochs': result['epochs']}
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    reference = report[args.precisions[0]]
+    top_k = base['top_k']
+    print(f"{'precision':<12}{'samples/s':>12}{'speedup':>9}{'HR@' + str(top_k):>10}{'delta':>9}{'NDCG@' + str(top_k):>10}{'delta':>9}")
+    for name, r in report.items():
+        r['speedup'] = r['samples_per_sec'] / reference['samples_per_sec']
+        r['delta_hr'] = r['hr'] - reference['hr']
+        r['delta_ndcg'] = r['ndcg'] - reference['ndcg']
+        print(f"{name:<12}{r['samples_per_sec']:>12.1f}{r['speedup']:>9.2f}{r['hr']:>10.4f}{r['delta_hr']:>+9.4f}"
+              f"{r['ndcg']:>10.4f}{r['delta_ndcg']:>+9.4f}")
+
+    flags = open('/proc/cpuinfo').read().split() if os.path.exists('/proc/cpuinfo') else []
+    meta = {'date': datetime.now().isoformat(timespec='seconds'),
+            'torch': torch.__version__,
+            'processor': platform.processor(),
+            'cpu_count': os.cpu_count(),
+            'torch_threads': torch.get_num_threads(),
+            'cpu_bf16': {flag: flag in flags for flag in ('avx512_bf16', 'amx_bf16')},
+            'config': args.config}
+    with open(args.output, 'w') as f:
+        json.dump({'meta': meta, 'results': report}, f, indent=2)
+    print(f'wrote {args.output}')
+
+
+def compare(args):
+    """ Print current vs baseline medians, exit 1 if any benchmark slowed down beyond threshold """
+    with open(args.current, 'r') as f:
+        current = json.load(f)['results']
+    with open(args.baseline, 'r') as f:
+        baseline = json.load(f)['results']
+
+    regressions = []
+    print(f"{'benchmark':<56}{'baseline ms':>14}{'current ms':>14}{'ratio':>8}")
+    for name in sorted(set(current) | set(baseline)):
+        if name not in current or name not in baseline:
+            print(f"{name:<56}{'only in ' + ('current' if name in current else 'baseline'):>36}")
+            continue
+        ratio = current[name]['median'] / baseline[name]['median']
+        flag = ''
+        if ratio > 1 + args.threshold:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        elif ratio < 1 - args.threshold:
+            flag = '  faster'
+        print(f"{name:<56}{baseline[name]['median'] * 1e3:>14.3f}{current[name]['median'] * 1e3:>14.3f}{ratio:>8.2f}{flag}")
+
+    if regressions:
+        print(f'{len(regressions)} regression(s) over {args.threshold:.0%}')
+        sys.exit(1)
+    print('no regressions')
+
+
+def main():
+    args = arg_parse()
+    if args.command == 'run':
+        run_benchmarks(args)
+    elif args.command == 'precision':
+        bench_precision(args)
+    else:
+        compare(args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+
+def write_dataset(out_dir, user_num, item_num, num_interactions, num_candidates = 100,
+                  user_aux = 21, item_aux = 18, seed = 0):
+    """Write MovieLens-shaped synthetic data files
+
+    Files match what data.ipynb produces: main_data_train_ml.csv
+    (User_ID, MovieID, neg_item), main_data_test_ml.npy ([user, [gt] + negatives])
+    and the ml_users.csv / ml_movies.csv auxiliary tables.
+
+    Args:
+        out_dir (str): directory to write into
+        user_num (int): number of users
+        item_num (int): number of items
+        num_interactions (int): number of train interactions
+        num_candidates (int, optional): candidates per test user. Defaults to 100.
+        user_aux (int, optional): number of user aux classes. Defaults to 21.
+        item_aux (int, optional): number of item aux classes. Defaults to 18.
+        seed (int, optional): random seed. Defaults to 0.
+
+    Returns:
+        dict: CustomDataset path arguments
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(out_dir, exist_ok=True)
+
+    # every user gets at least one interaction, the rest are spread at random
+    users = np.concatenate([np.arange(user_num), rng.integers(user_num, size=max(0, num_interactions - user_num))])
+    users.sort()
+    items = rng.integers(item_num, size=len(users))
+    items[-1] = item_num - 1
+    negs = rng.integers(item_num, size=len(users))
+    pd.DataFrame({'User_ID': users, 'MovieID': items, 'neg_item': negs}).to_csv(
+        os.path.join(out_dir, 'main_data_train_ml.csv'), index=False)
+
+    candidates = rng.integers(item_num, size=(user_num, num_candidates))
+    test = np.empty((user_num, 2), dtype=object)
+    test[:, 0] = np.arange(user_num)
+    test[:, 1] = list(candidates.tolist())
+    np.save(os.path.join(out_dir, 'main_data_test_ml.npy'), test, allow_pickle=True)
+
+    pd.DataFrame({'User_ID': np.arange(user_num), 'aux': rng.integers(user_aux, size=user_num)}).to_csv(
+        os.path.join(out_dir, 'ml_users.csv'), index=False)
+    pd.DataFrame({'MovieID': np.arange(item_num), 'Genres': rng.integers(item_aux, size=item_num)}).to_csv(
+        os.path.join(out_dir, 'ml_movies.csv'), index=False)
+
+    return {'data_path_main_train': os.path.join(out_dir, 'main_data_train_ml.csv'),
+            'data_path_main_test': os.path.join(out_dir, 'main_data_test_ml.npy'),
+            'data_path_aux_user': os.path.join(out_dir, 'ml_users.csv'),
+            'data_path_aux_item': os.path.join(out_dir, 'ml_movies.csv')}
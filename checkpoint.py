@@ -0,0 +1,111 @@
+import os
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+INDEX_FILE = 'checkpoints.json'
+
+
+def snapshot(obj):
+    """ Copy of a (nested) state dict with every tensor cloned to cpu """
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy = True)
+    if isinstance(obj, dict):
+        return {k: snapshot(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(v) for v in obj)
+    return obj
+
+
+def atomic_save(obj, path):
+    """ torch.save to a temp file renamed over path, readers never see a partial file """
+    tmp_path = f'{path}.tmp{os.getpid()}'
+    torch.save(obj, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def read_index(saved_dir):
+    """ Checkpoint index of a run, {'save_mode': str, 'checkpoints': [records]} """
+    path = os.path.join(saved_dir, INDEX_FILE)
+    if not os.path.exists(path):
+        return {'save_mode': 'hr', 'checkpoints': []}
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def best_checkpoint(saved_dir):
+    """ Path of the best indexed checkpoint of a run, None without an index """
+    index = read_index(saved_dir)
+    if not index['checkpoints']:
+        return None
+    best = max(index['checkpoints'], key = lambda r: (r[index['save_mode']], r['epoch']))
+    return os.path.join(saved_dir, best['path'])
+
+
+class CheckpointWriter:
+    """ Saves checkpoints from a background thread with score-aware retention
+
+    `save` only snapshots the model/optimizer/scheduler state to cpu memory;
+    serialization, the atomic rename, the index update and deletions run in
+    one writer thread. At most one write is in flight, so a new `save` waits
+    for the previous one and re-raises its error.
+
+    `{saved_dir}/checkpoints.json` lists (epoch, hr, ndcg, path) of the kept
+    checkpoints: the num_to_remain best by save_mode plus the latest one.
+
+    Args:
+        saved_dir (str): run directory
+        num_to_remain (int, optional): best checkpoints kept. Defaults to 3.
+        save_mode (str, optional): 'hr' or 'ndcg', the score ranking checkpoints. Defaults to 'hr'.
+    """
+    def __init__(self, saved_dir, num_to_remain = 3, save_mode = 'hr'):
+        self.saved_dir = saved_dir
+        self.num_to_remain = num_to_remain
+        self.save_mode = save_mode
+        self.records = read_index(saved_dir)['checkpoints']
+        self.executor = ThreadPoolExecutor(max_workers = 1)
+        self.future = None
+
+    def save(self, epoch, model, hr, ndcg, optimizer, scheduler, file_name):
+        """ Snapshot the training state and queue it for writing """
+        self.wait()
+        check_point = {'epoch': epoch,
+                       'model': model.state_dict(),
+                       'optimizer_state_dict': optimizer.state_dict(),
+                       'hr': hr,
+                       'ndcg' : ndcg}
+        if scheduler:
+            check_point['scheduler_state_dict'] = scheduler.state_dict()
+        check_point = snapshot(check_point)
+        record = {'epoch': epoch, 'hr': hr, 'ndcg': ndcg, 'path': file_name}
+        self.future = self.executor.submit(self._write, check_point, record)
+
+    def _write(self, check_point, record):
+        atomic_save(check_point, os.path.join(self.saved_dir, record['path']))
+        self.records = [r for r in self.records if r['path'] != record['path']] + [record]
+
+        ranked = sorted(self.records, key = lambda r: (r[self.save_mode], r['epoch']), reverse = True)
+        keep = {r['path'] for r in ranked[:self.num_to_remain]} | {record['path']}
+        removed = [r for r in self.records if r['path'] not in keep]
+        self.records = [r for r in self.records if r['path'] in keep]
+
+        # the index never points at a deleted file
+        index_path = os.path.join(self.saved_dir, INDEX_FILE)
+        with open(f'{index_path}.tmp', 'w') as f:
+            json.dump({'save_mode': self.save_mode, 'checkpoints': self.records}, f, indent=2)
+        os.replace(f'{index_path}.tmp', index_path)
+        for r in removed:
+            path = os.path.join(self.saved_dir, r['path'])
+            if os.path.exists(path):
+                os.remove(path)
+
+    def wait(self):
+        """ Block until the pending write is done, re-raising its error """
+        if self.future is not None:
+            future, self.future = self.future, None
+            future.result()
+
+    def close(self):
+        self.wait()
+        self.executor.shutdown()
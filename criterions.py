@@ -2,39 +2,97 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+REDUCTIONS = ('mean', 'sum', 'none')
+
+
+def reduce_loss(loss, reduction = 'mean', mask = None):
+    """ Reduce per-sample losses, ignoring masked-out samples """
+    """
+    'sum' and 'mean' accumulate in float64, so large batches keep the
+    precision of every term; 'none' returns the (masked-to-zero) losses.
+    """
+    if mask is not None:
+        loss = loss * mask
+    if reduction == 'none':
+        return loss
+    total = loss.sum(dtype = torch.float64)
+    if reduction == 'mean':
+        count = mask.sum(dtype = torch.float64).clamp(min = 1) if mask is not None else max(loss.numel(), 1)
+        total = total / count
+    return total.to(loss.dtype)
+
 
 class CustomLoss(nn.Module):
-    def __init__(self, lambda_main, lambda_user, lambda_item):
+    def __init__(self, lambda_main, lambda_user, lambda_item, reduction = 'mean'):
+        """ BCE on the main logit plus cross-entropy of the auxiliary heads
+
+        Args:
+            lambda_main (float): weight of the main loss, null for 1
+            lambda_user (float): weight of the user aux loss, null/0 to skip the head
+            lambda_item (float): weight of the item aux loss, null/0 to skip the head
+            reduction (str, optional): 'mean', 'sum' or 'none' over the batch. Defaults to 'mean'.
+        """
         super().__init__()
-        self.lambda_main = lambda_main
+        assert reduction in REDUCTIONS, f'unknown reduction {reduction}'
+        self.lambda_main = lambda_main if lambda_main is not None else 1.
         self.lambda_user = lambda_user
         self.lambda_item = lambda_item
-        self.criterion = nn.BCEWithLogitsLoss()
+        self.reduction = reduction
+
+    @property
+    def outputs(self):
+        """ Model heads the loss uses, aux heads with a null/zero lambda are skipped """
+        outputs = ('main',)
+        if self.lambda_user:
+            outputs += ('user',)
+        if self.lambda_item:
+            outputs += ('item',)
+        return outputs
+
+    def aux_loss(self, logits, label):
+        # aux targets are class ids (aux2id), -1 where the user/item has no aux information
+        label = label.view(-1)
+        known = label >= 0
+        loss = F.cross_entropy(logits, label.clamp(min = 0), reduction = 'none')
+        return reduce_loss(loss, self.reduction, known.to(loss.dtype))
 
     def forward(self, pred, pred_user, pred_item, label, label_user, label_item):
-        loss_main = self.criterion(pred, label)
+        loss_main = F.binary_cross_entropy_with_logits(pred.view(-1), label.view(-1).to(pred.dtype), reduction = 'none')
+        loss = self.lambda_main * reduce_loss(loss_main, self.reduction)
         if self.lambda_user:
-            loss_user = self.criterion(pred_user, label_user)
+            loss = loss + self.lambda_user * self.aux_loss(pred_user, label_user)
         if self.lambda_item:
-            loss_item = self.criterion(pred_item, label_item)
-
-        if self.lambda_item and self.lambda_user:
-            loss = self.lambda_main * loss_main + self.lambda_user * loss_user\
-                + self.lambda_item * loss_item
-        elif self.lambda_item:
-            loss = self.lambda_main * loss_main + self.lambda_item * loss_item
-        elif self.lambda_user:
-            loss = self.lambda_main * loss_main + self.lambda_user * loss_user
-        else:
-            loss = loss_main
+            loss = loss + self.lambda_item * self.aux_loss(pred_item, label_item)
         return loss
 
+
 class BPRLoss(nn.Module):
-    def __init__(self, lambda_main, lambda_user, lambda_item):
+    def __init__(self, lambda_main, lambda_user, lambda_item, reduction = 'sum', objective = 'bpr'):
+        """ Pairwise ranking loss of positive scores against a (b, num_neg) matrix of negatives
+
+        'bpr' is softplus(neg - pos) = -log sigmoid(pos - neg) per (positive, negative)
+        pair; 'softmax' is the sampled softmax -log_softmax([pos, negs])[0] per positive.
+        Both are single fused ops over the negative matrix and never overflow.
+
+        Args:
+            lambda_main (float): weight of the loss, null for 1
+            lambda_user (float): must be null/0, ONCF has no auxiliary heads
+            lambda_item (float): must be null/0, ONCF has no auxiliary heads
+            reduction (str, optional): 'mean', 'sum' or 'none'. Defaults to 'sum'.
+            objective (str, optional): 'bpr' or 'softmax'. Defaults to 'bpr'.
+        """
         super().__init__()
-        self.sigmoid = nn.Sigmoid()
+        assert reduction in REDUCTIONS, f'unknown reduction {reduction}'
+        assert objective in ('bpr', 'softmax'), f'unknown objective {objective}'
+        assert not (lambda_user or lambda_item), 'BPRLoss has no auxiliary heads, set lambda_user/lambda_item to null'
+        self.lambda_main = lambda_main if lambda_main is not None else 1.
+        self.reduction = reduction
+        self.objective = objective
 
     def forward(self, pos_preds, neg_preds):
-        distance = pos_preds - neg_preds
-        loss = torch.sum(torch.log((1+torch.exp(-distance))))
-        return loss
\ No newline at end of file
+        # (b, 1) positives broadcast against (b, k) negatives
+        if self.objective == 'bpr':
+            loss = F.softplus(neg_preds - pos_preds)
+        else:
+            loss = torch.logsumexp(torch.cat([pos_preds, neg_preds], dim = 1), dim = 1) - pos_preds.view(-1)
+        return self.lambda_main * reduce_loss(loss, self.reduction)
@@ -1,47 +1,273 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np 
 import pandas as pd 
-import scipy.sparse as sp
 
 from sklearn.model_selection import train_test_split
 
 import torch
 import torch.utils.data as data
 
+CACHE_VERSION = 2
+_loaded = {}
+
+def _fingerprint(path):
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+def _file_hash(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def _cache_dir(*paths, tag=''):
+    """ Cache directory next to the first source file. """
+    stems = '__'.join(os.path.splitext(os.path.basename(p))[0] for p in paths) + tag
+    return os.path.join(os.path.dirname(os.path.abspath(paths[0])), '.cache', f'{stems}.v{CACHE_VERSION}')
+
+def _cache_valid(cache_dir, sources):
+    """ Check a cache against its sources by size/mtime, then by content hash. """
+    meta_path = os.path.join(cache_dir, 'meta.json')
+    if not os.path.exists(meta_path):
+        return False
+    with open(meta_path, 'r') as f:
+        meta = json.load(f)
+    if meta.get('version') != CACHE_VERSION or set(meta['sources']) != set(sources):
+        return False
+    stale = [p for p in sources if meta['sources'][p]['stat'] != _fingerprint(p)]
+    if not stale:
+        return True
+    # touched but unchanged files only refresh the recorded stat
+    if any(meta['sources'][p]['sha1'] != _file_hash(p) for p in stale):
+        return False
+    for p in stale:
+        meta['sources'][p]['stat'] = _fingerprint(p)
+    with open(meta_path, 'w') as f:
+        json.dump(meta, f)
+    return True
+
+def _write_cache(cache_dir, sources, arrays, **meta):
+    """ Write arrays as .npy files and swap the directory in atomically. """
+    tmp_dir = f'{cache_dir}.tmp{os.getpid()}'
+    os.makedirs(tmp_dir, exist_ok=True)
+    for name, arr in arrays.items():
+        np.save(os.path.join(tmp_dir, f'{name}.npy'), np.ascontiguousarray(arr))
+    meta.update(version=CACHE_VERSION,
+                sources={p: {'stat': _fingerprint(p), 'sha1': _file_hash(p)} for p in sources})
+    with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+    if os.path.exists(cache_dir):
+        shutil.rmtree(cache_dir, ignore_errors=True)
+    try:
+        os.replace(tmp_dir, cache_dir)
+    except OSError:
+        # another process finished the same cache first
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+def _read_cache(cache_dir, names):
+    arrays = {name: np.load(os.path.join(cache_dir, f'{name}.npy'), mmap_mode='r') for name in names}
+    with open(os.path.join(cache_dir, 'meta.json'), 'r') as f:
+        meta = json.load(f)
+    return arrays, meta
+
+class InteractionIndex:
+    """ Compact user-item interaction index. """
+    """
+    Interactions are kept as CSR row pointers plus sorted packed
+    `user * num_item + item` keys (8 bytes per interaction), so membership of
+    a whole batch of pairs is a single np.searchsorted.
+
+    indptr: (num_user + 1,) row pointers
+    indices: sorted item ids of each row, concatenated
+    num_item: number of items
+    """
+    def __init__(self, indptr, indices, num_item):
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.num_user = len(self.indptr) - 1
+        self.num_item = int(num_item)
+        users = np.repeat(np.arange(self.num_user, dtype=np.int64), np.diff(self.indptr))
+        self.keys = users * self.num_item + np.asarray(indices, dtype=np.int64)
+
+    @classmethod
+    def from_keys(cls, indptr, keys, num_item):
+        """ Wrap sorted, deduplicated packed keys (e.g. memory-mapped) without copying them. """
+        index = cls.__new__(cls)
+        index.indptr = np.asarray(indptr, dtype=np.int64)
+        index.num_user = len(index.indptr) - 1
+        index.num_item = int(num_item)
+        index.keys = keys
+        return index
+
+    @property
+    def shape(self):
+        return (self.num_user, self.num_item)
+
+    @property
+    def nbytes(self):
+        return self.indptr.nbytes + self.keys.nbytes
+
+    def __len__(self):
+        return len(self.keys)
+
+    def contains(self, users, items):
+        """ Bool array, True where (users[k], items[k]) is an interaction. """
+        query = np.asarray(users, dtype=np.int64) * self.num_item + np.asarray(items, dtype=np.int64)
+        if len(self.keys) == 0:
+            return np.zeros(query.shape, dtype=bool)
+        pos = np.searchsorted(self.keys, query)
+        pos[pos == len(self.keys)] = 0
+        return self.keys[pos] == query
+
+    def pairs(self, users):
+        """ (row, item) of every positive of a batch of users, row indexing into users. """
+        users = np.asarray(users, dtype=np.int64)
+        starts = self.indptr[users]
+        lengths = self.indptr[users + 1] - starts
+        rows = np.repeat(np.arange(len(users)), lengths)
+        offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths) + starts[rows]
+        return rows, self.keys[offsets] - users[rows] * self.num_item
+
+def _csv_to_memmap(data_path, out_path, chunk_size):
+    """ Copy an integer CSV to a raw int64 file chunk by chunk and memory-map it. """
+    num_rows, num_cols = 0, 0
+    with open(out_path, 'wb') as f:
+        for chunk in pd.read_csv(data_path, dtype=np.int64, chunksize=chunk_size):
+            values = np.ascontiguousarray(chunk.values, dtype=np.int64)
+            values.tofile(f)
+            num_rows, num_cols = num_rows + len(values), values.shape[1]
+    return np.memmap(out_path, dtype=np.int64, mode='r', shape=(num_rows, num_cols))
+
+def _build_index(pairs, num_user, num_item, out_path, chunk_size):
+    """ InteractionIndex arrays of (user, item) rows through an on-disk counting sort. """
+    """
+    Rows are scattered behind the earlier rows of their user into a
+    memory-mapped key array, then blocks of whole users (about chunk_size
+    keys) are sorted and deduplicated in place.
+
+    Returns: indptr, sorted unique packed keys (memory-mapped)
+    """
+    indptr = np.zeros(num_user + 1, dtype=np.int64)
+    for start in range(0, len(pairs), chunk_size):
+        indptr[1:] += np.bincount(pairs[start:start + chunk_size, 0], minlength=num_user)
+    np.cumsum(indptr, out=indptr)
+
+    keys = np.lib.format.open_memmap(out_path, mode='w+', dtype=np.int64, shape=(len(pairs),))
+    cursor = indptr[:-1].copy()
+    for start in range(0, len(pairs), chunk_size):
+        users = np.asarray(pairs[start:start + chunk_size, 0])
+        items = np.asarray(pairs[start:start + chunk_size, 1])
+        order = np.argsort(users, kind='stable')
+        users = users[order]
+        # position of every row among this chunk's rows of the same user
+        within = np.arange(len(users)) - np.searchsorted(users, users)
+        keys[cursor[users] + within] = users * num_item + items[order]
+        cursor += np.bincount(users, minlength=num_user)
+
+    counts = np.zeros(num_user, dtype=np.int64)
+    written, user = 0, 0
+    while user < num_user:
+        end = int(np.searchsorted(indptr, indptr[user] + chunk_size, 'right')) - 1
+        end = min(max(end, user + 1), num_user)
+        block = np.unique(keys[indptr[user]:indptr[end]])
+        keys[written:written + len(block)] = block
+        counts[user:end] = np.bincount(block // num_item - user, minlength=end - user)
+        written += len(block)
+        user = end
+    keys.flush()
+    np.cumsum(counts, out=indptr[1:])
+    return indptr, keys[:written]
+
+def compile_main(data_path_train: str,
+                 data_path_test: str,
+                 chunk_size: int = 1 << 22):
+    """ Parse the main data once and write the binary cache. """
+    """
+    train.npy: (n, c) int64 train rows (user, item[, neg_item])
+    test.npy: (m, 2) int64 (user, candidate item) pairs, ground truth first per user
+    indptr.npy, keys.npy: InteractionIndex of the train interactions
+
+    The train CSV is parsed chunk_size rows at a time and indexed on disk, so
+    peak memory does not grow with the number of interactions.
+    """
+    cache_dir = _cache_dir(data_path_train, data_path_test)
+    scratch_dir = f'{cache_dir}.scratch{os.getpid()}'
+    os.makedirs(scratch_dir, exist_ok=True)
+    try:
+        train_data = _csv_to_memmap(data_path_train, os.path.join(scratch_dir, 'train.bin'), chunk_size)
+
+        user_num, item_num = 0, 0
+        for start in range(0, len(train_data), chunk_size):
+            chunk = train_data[start:start + chunk_size]
+            user_num = max(user_num, int(chunk[:, 0].max()) + 1)
+            item_num = max(item_num, int(chunk[:, 1].max()) + 1)
+
+        indptr, keys = _build_index(train_data, user_num, item_num,
+                                    os.path.join(scratch_dir, 'keys.npy'), chunk_size)
+
+        # test data : [user, [candidate items]] rows
+        test_data_raw = np.load(
+        data_path_test, allow_pickle=True)
+        lengths = np.fromiter((len(x) for x in test_data_raw[:, 1]), dtype=np.int64, count=len(test_data_raw))
+        test_data = np.stack([np.repeat(test_data_raw[:, 0].astype(np.int64), lengths),
+                              np.concatenate(test_data_raw[:, 1]).astype(np.int64)], axis=1)
+
+        _write_cache(cache_dir, [data_path_train, data_path_test],
+                     {'train': train_data, 'test': test_data, 'indptr': indptr, 'keys': keys},
+                     user_num=user_num, item_num=item_num)
+    finally:
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+
 def load_all(data_path_train: str,
             data_path_test: str):
     """ We load all the three file here to save time in each epoch. """
     """
     data_path_train: 학습 데이터 경로
     data_path_test: 평가 데이터 경로
+
+    Arrays are memory-mapped from the binary cache, compiled on first use,
+    and shared by every dataset built from the same files.
     """
-    train_data = pd.read_csv(
-        data_path_train, dtype={0: np.int32, 1: np.int32, 2:np.int32})
+    sources = [os.path.abspath(data_path_train), os.path.abspath(data_path_test)]
+    cache_dir = _cache_dir(*sources)
+    if cache_dir not in _loaded:
+        if not _cache_valid(cache_dir, sources):
+            compile_main(*sources)
+        arrays, meta = _read_cache(cache_dir, ['train', 'test', 'indptr', 'keys'])
+        train_mat = InteractionIndex.from_keys(arrays['indptr'], arrays['keys'], meta['item_num'])
+        _loaded[cache_dir] = arrays, meta, train_mat
+    arrays, meta, train_mat = _loaded[cache_dir]
+    user_num, item_num = meta['user_num'], meta['item_num']
+
+    return arrays['train'], arrays['test'], user_num, item_num, train_mat
 
-    user_num = train_data['User_ID'].max() + 1
+def _read_aux_csv(data_path, **kwargs):
     try:
-        item_num = train_data['MovieID'].max() + 1
+        return pd.read_csv(data_path, encoding='cp949', **kwargs)
     except:
-        item_num = train_data['ISBN'].max() + 1
-
-    train_data = train_data.values.tolist()
+        return pd.read_csv(data_path, **kwargs)
 
-    # load ratings as a dok matrix
-    train_mat = sp.dok_matrix((user_num, item_num), dtype=np.float32)
-    for x in train_data:
-        train_mat[x[0], x[1]] = 1.0
+def compile_aux(data_path: str,
+                id_col: str,
+                aux_col: str):
+    """ Parse an auxiliary information file once and write the binary cache. """
+    data = _read_aux_csv(data_path)
     
-    # test data
-    test_data_raw = np.load(
-    data_path_test, allow_pickle=True)
-    
-    test_data = []
-    for data in test_data_raw:
-        u = data[0]
-        i = data[1]
-        for item in i:
-            test_data.append([u, int(item)])
+    id2aux = dict(enumerate(data[aux_col].unique()))
+    aux2id = {j:i for i, j in id2aux.items()}
+
+    aux_data = data.groupby(id_col)[aux_col].unique().map(lambda x: x[0]).reset_index()
+    aux_data[aux_col] = aux_data[aux_col].map(lambda x: aux2id[x])
 
-    return train_data, test_data, user_num, item_num, train_mat
+    _write_cache(_cache_dir(data_path, tag=f'.{id_col}.{aux_col}'), [data_path],
+                 {'ids': aux_data[id_col].values.astype(np.int64), 'aux': aux_data[aux_col].values.astype(np.int64)},
+                 labels=[str(id2aux[i]) for i in range(len(id2aux))])
 
 def load_aux(data_path: str,
             id_col: str,
@@ -52,26 +278,220 @@ def load_aux(data_path: str,
     id_col: "user" or "item"
     aux_col: auxiliary 정보가 있는 column명
     """
+    data_path = os.path.abspath(data_path)
+    cache_dir = _cache_dir(data_path, tag=f'.{id_col}.{aux_col}')
+    if cache_dir not in _loaded:
+        if not _cache_valid(cache_dir, [data_path]):
+            # fail fast on a wrong column guess without parsing the whole file
+            columns = _read_aux_csv(data_path, nrows=0).columns
+            if id_col not in columns or aux_col not in columns:
+                raise KeyError(f'{data_path} has no {id_col}/{aux_col} columns')
+            compile_aux(data_path, id_col, aux_col)
+        _loaded[cache_dir] = _read_cache(cache_dir, ['ids', 'aux'])
+    arrays, _ = _loaded[cache_dir]
+
+    res = dict(zip(arrays['ids'].tolist(), arrays['aux'].tolist()))
+    
+    return res
+
+def aux_table(aux, num):
+    """ Dense id -> aux id lookup array, -1 for ids without auxiliary information. """
+    """
+    aux: dict from load_aux
+    num: minimum table size (user_num or item_num)
+    """
+    table = np.full(max(num, max(aux) + 1), -1, dtype=np.int64)
+    table[np.fromiter(aux.keys(), dtype=np.int64)] = np.fromiter(aux.values(), dtype=np.int64)
+    return table
+
+def load_aux_pair(data_path_aux_user, data_path_aux_item):
+    """ User and item auxiliary information of either supported dataset. """
+    # loading user auxiliary information data
     try:
-        data = pd.read_csv(data_path, encoding='cp949')
+        aux_user = load_aux(data_path_aux_user, 'User_ID', 'aux')
     except:
-        data = pd.read_csv(data_path)
-    
-    id2aux = dict(enumerate(data[aux_col].unique()))
-    aux2id = {j:i for i, j in id2aux.items()}
+        aux_user = load_aux(data_path_aux_user, 'User_ID', 'Age')
 
-    aux_data = data.groupby(id_col)[aux_col].unique().map(lambda x: x[0]).reset_index()
-    aux_data[id_col] = aux_data[id_col]
-    aux_data[aux_col] = aux_data[aux_col].map(lambda x: aux2id[x])
+    # loading item auxiliary information data
+    try:
+        aux_item = load_aux(data_path_aux_item, 'MovieID', 'Genres')
+    except:
+        aux_item = load_aux(data_path_aux_item, 'ISBN', 'Publisher')
+    return aux_user, aux_item
 
-    res = dict(aux_data.values)
-    
-    return res
+class NegativeSampler:
+    """ Uniform negative items, base class of the samplers """
+    """
+    Subclasses change the proposal distribution by overriding draw. sample
+    rejects proposals the user interacted with and redraws them in rounds,
+    and keeps running cost statistics read with pop_stats.
+
+    num_item: number of items
+    """
+    uses_model = False
+
+    def __init__(self, num_item):
+        self.num_item = num_item
+        self.stats = {}
+
+    def draw(self, size, rng):
+        """ size proposed negative items """
+        return rng.integers(self.num_item, size=size)
+
+    def _reject(self, users, items, train_mat, rng, max_rounds=100):
+        """ Redraw items that collide with train_mat until none is left. """
+        collide = np.flatnonzero(train_mat.contains(users, items))
+        rounds = 0
+        while len(collide):
+            # proposals concentrated on a user's positives fall back to uniform draws
+            if rounds < max_rounds:
+                items[collide] = self.draw(len(collide), rng)
+            else:
+                items[collide] = rng.integers(self.num_item, size=len(collide))
+            self._count(draws=len(collide))
+            collide = collide[train_mat.contains(users[collide], items[collide])]
+            rounds += 1
+        return items
+
+    def sample(self, users, num_ng, train_mat, rng):
+        """ num_ng non-interacted items per user, returned as (users, items) """
+        start = time.perf_counter()
+        users = np.repeat(np.asarray(users, dtype=np.int64), num_ng)
+        items = self.draw(len(users), rng)
+        self._count(draws=len(users))
+        items = self._reject(users, items, train_mat, rng)
+        self._count(negatives=len(users), seconds=time.perf_counter() - start)
+        return users, items
+
+    def _count(self, **values):
+        for k, v in values.items():
+            self.stats[k] = self.stats.get(k, 0) + v
+
+    def pop_stats(self):
+        """ Statistics since the last call: negatives, draws, scored pairs and seconds """
+        stats, self.stats = self.stats, {}
+        stats['sampler'] = type(self).__name__
+        return stats
+
+class PopularitySampler(NegativeSampler):
+    """ Negatives drawn with probability proportional to popularity ** alpha """
+    """
+    An alias table built once from the train interactions gives O(1) draws.
+    alpha=1 matches in-batch negatives (items of other positives), alpha=0
+    is uniform over items with at least one interaction.
+
+    train_mat: InteractionIndex of the train interactions
+    alpha: popularity exponent
+    """
+    def __init__(self, num_item, train_mat, alpha=0.75, chunk_size=1 << 22):
+        super(PopularitySampler, self).__init__(num_item)
+        self.alpha = alpha
+        counts = np.zeros(num_item, dtype=np.int64)
+        for start in range(0, len(train_mat.keys), chunk_size):
+            counts += np.bincount(train_mat.keys[start:start + chunk_size] % num_item, minlength=num_item)
+        weights = np.where(counts > 0, counts.astype(np.float64) ** alpha, 0.)
+        self.prob, self.alias = alias_table(weights)
+
+    def draw(self, size, rng):
+        slots = rng.integers(self.num_item, size=size)
+        return np.where(rng.random(size) < self.prob[slots], slots, self.alias[slots])
+
+class HardNegativeSampler(NegativeSampler):
+    """ Model-scored hard negatives picked from a pool of proposals """
+    """
+    Each negative gets pool_size valid proposals from the pool sampler,
+    which the current model scores in no-grad batches of score_batch
+    negatives. The highest scored proposal is kept (temperature=0) or one
+    is sampled from softmax(score / temperature). Without a scorer the first
+    proposal is kept, i.e. the pool distribution.
+
+    pool: NegativeSampler proposing the candidates
+    pool_size: proposals per negative
+    score_batch: negatives scored per model call
+    temperature: 0 for the hardest proposal, > 0 to sample by score
+    """
+    uses_model = True
+
+    def __init__(self, pool, pool_size=10, score_batch=4096, temperature=0.):
+        super(HardNegativeSampler, self).__init__(pool.num_item)
+        self.pool = pool
+        self.pool_size = pool_size
+        self.score_batch = score_batch
+        self.temperature = temperature
+        self.scorer = None
+
+    def draw(self, size, rng):
+        return self.pool.draw(size, rng)
+
+    def sample(self, users, num_ng, train_mat, rng):
+        start = time.perf_counter()
+        users = np.repeat(np.asarray(users, dtype=np.int64), num_ng)
+        pool_users = np.repeat(users, self.pool_size)
+        pool = self.draw(len(pool_users), rng)
+        self._count(draws=len(pool_users))
+        pool = self._reject(pool_users, pool, train_mat, rng).reshape(len(users), self.pool_size)
+
+        if self.scorer is None:
+            items = pool[:, 0]
+        else:
+            items = np.empty(len(users), dtype=np.int64)
+            for s in range(0, len(users), self.score_batch):
+                scores = self.scorer(users[s:s + self.score_batch], pool[s:s + self.score_batch])
+                if self.temperature > 0:
+                    scores = scores / self.temperature + rng.gumbel(size=scores.shape)
+                items[s:s + self.score_batch] = pool[s:s + self.score_batch][np.arange(len(scores)), scores.argmax(1)]
+            self._count(scored=pool.size)
+        self._count(negatives=len(users), seconds=time.perf_counter() - start)
+        return users, items
+
+def alias_table(weights):
+    """ Vose alias table (prob, alias) of unnormalized weights """
+    n = len(weights)
+    prob = np.asarray(weights, dtype=np.float64) * n / np.sum(weights)
+    alias = np.arange(n, dtype=np.int64)
+    small = [i for i in range(n) if prob[i] < 1.]
+    large = [i for i in range(n) if prob[i] >= 1.]
+    while small and large:
+        s, l = small.pop(), large.pop()
+        alias[s] = l
+        prob[l] -= 1. - prob[s]
+        (small if prob[l] < 1. else large).append(l)
+    prob[small + large] = 1.
+    return prob, alias
+
+def build_sampler(cfg, num_item, train_mat):
+    """ Negative sampler from the "sampler" dataset argument """
+    """
+    cfg: None or {"name": "uniform"}, {"name": "popularity", "alpha": 0.75},
+         {"name": "hard", "pool": "uniform" | "popularity" | "in_batch",
+          "pool_size": 10, "score_batch": 4096, "temperature": 0, "alpha": 0.75}
+    """
+    cfg = dict(cfg._asdict() if hasattr(cfg, '_asdict') else cfg or {})
+    name = cfg.pop('name', 'uniform')
+    if name == 'uniform':
+        return NegativeSampler(num_item)
+    if name == 'popularity':
+        return PopularitySampler(num_item, train_mat, **cfg)
+    if name == 'in_batch':
+        return PopularitySampler(num_item, train_mat, alpha=1.)
+    if name == 'hard':
+        pool = {'name': cfg.pop('pool', 'uniform')}
+        if 'alpha' in cfg:
+            pool['alpha'] = cfg.pop('alpha')
+        return HardNegativeSampler(build_sampler(pool, num_item, train_mat), **cfg)
+    raise ValueError(f'unknown negative sampler {name}')
+
+def format_sampler_stats(stats):
+    """ One line summary of NegativeSampler.pop_stats """
+    negatives = max(stats.get('negatives', 0), 1)
+    return (f"negative sampling ({stats['sampler']}): {stats.get('negatives', 0)} negatives in "
+            f"{stats.get('seconds', 0.):.2f}s, {stats.get('draws', 0) / negatives:.2f} draws and "
+            f"{stats.get('scored', 0) / negatives:.1f} scored pairs per negative")
 
 class CustomDataset(data.Dataset):
     def __init__(self, data_path_main_train : str, data_path_main_test : str,
                  data_path_aux_user = None, data_path_aux_item = None,
-                 num_ng=0, is_training=None):
+                 num_ng=0, is_training=None, ng_background=False, sampler=None, pairwise=False):
         super(CustomDataset, self).__init__()
         """ Note that the labels are only useful when training, we thus 
             add them in the ng_sample() function.
@@ -83,88 +503,322 @@ class CustomDataset(data.Dataset):
         data_path_aux_item: item auxiliary information 데이터 경로
         num_ng: negative sampling 비율 (vs positive sample)
         is_training: training 여부
+        ng_background: 다음 epoch의 negative sampling을 background thread에서 미리 수행
+        sampler: negative sampler 설정 (build_sampler 참고, 기본 uniform)
+        pairwise: positive 1개당 sample 1개, sampled negative는 (num_ng,) neg_item으로 (BPRLoss)
         """
 
         # loading main data
         train_data, test_data, user_num, item_num, train_mat = load_all(data_path_main_train, data_path_main_test)
         
-        # loading user auxiliary information data
-        try:
-            self.aux_user = load_aux(data_path_aux_user, 'User_ID', 'aux')
-        except:
-            self.aux_user = load_aux(data_path_aux_user, 'User_ID', 'Age')
-
-        # loading user auxiliary information data
-        try:
-            self.aux_item = load_aux(data_path_aux_item, 'MovieID', 'Genres')
-        except:
-            self.aux_item = load_aux(data_path_aux_item, 'ISBN', 'Publisher')
+        # loading user / item auxiliary information data
+        self.aux_user, self.aux_item = load_aux_pair(data_path_aux_user, data_path_aux_item)
         
         # 학습 여부에 따라 features 변수에 알맞는 데이터 할당
         if is_training == True:
             features = train_data
         elif is_training == False:
             features = test_data
-        
-        self.features_ps = features
+        features = np.asarray(features, dtype=np.int64).reshape(len(features), -1)
+
         self.num_item = item_num
         self.train_mat = train_mat
         self.num_ng = num_ng
         self.is_training = is_training
-        self.labels = [0 for _ in range(len(features))]
+        self.pairwise = pairwise
+        assert not (pairwise and is_training and num_ng < 1), 'pairwise sampling needs num_ng >= 1'
+
+        # columnar storage : one contiguous array per field
+        self.users_ps = features[:, 0]
+        self.items_ps = features[:, 1]
+        # train rows carry a pre-sampled negative in the third column
+        self.negs_ps = features[:, 2] if is_training and features.shape[1] > 2 else features[:, 1]
+        self.aux_user_table = aux_table(self.aux_user, user_num)
+        self.aux_item_table = aux_table(self.aux_item, item_num)
+        # candidate list length per user for evaluation, ground truth first
+        _, counts = np.unique(self.users_ps, return_counts=True)
+        self.num_candidates = int(counts[0]) if len(counts) and (counts == counts[0]).all() else None
+        self._set_columns(self.users_ps, self.items_ps, self.negs_ps,
+                          np.ones(len(features)) if is_training else np.zeros(len(features)))
+
+        # seeded from the global numpy state so that fix_seed controls sampling
+        self.rng = np.random.default_rng(np.random.randint(2 ** 31 - 1))
+        self.sampler = build_sampler(sampler, item_num, train_mat)
+        self.sampler_stats = None
+        # model-scored samplers must see the weights of the epoch they sample for
+        self.ng_background = ng_background and not self.sampler.uses_model
+        self._ng_executor = None
+        self._ng_future = None
+
+    def shard(self, rank, world_size):
+        """ Keep this rank's part of the samples for data-parallel training. """
+        """
+        Training samples are split into world_size equal parts (up to
+        world_size - 1 trailing positives are dropped) so every rank runs the
+        same number of steps. Evaluation samples are split by whole candidate
+        lists. Negative sampling then only covers the local positives.
+        """
+        if self.is_training:
+            keep = np.arange(rank, len(self.users_ps) // world_size * world_size, world_size)
+        else:
+            groups = np.arange(len(self.users_ps)) // self.num_candidates
+            keep = np.flatnonzero(groups % world_size == rank)
+        self.select(keep)
+        self.rng = np.random.default_rng([int(self.rng.integers(2 ** 31 - 1)), rank])
+        return self
+
+    def select(self, keep):
+        """ Keep only the samples (positive rows) at the indices keep, e.g. for incremental training. """
+        self.users_ps = self.users_ps[keep]
+        self.items_ps = self.items_ps[keep]
+        self.negs_ps = self.negs_ps[keep]
+        self._set_columns(self.users_ps, self.items_ps, self.negs_ps,
+                          np.ones(len(keep)) if self.is_training else np.zeros(len(keep)))
+        return self
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_ng_executor'] = None
+        state['_ng_future'] = None
+        return state
+
+    def _set_columns(self, users, items, negs, labels):
+        self.users = torch.from_numpy(np.ascontiguousarray(users, dtype=np.int64))
+        self.items = torch.from_numpy(np.ascontiguousarray(items, dtype=np.int64))
+        self.negs = torch.from_numpy(np.ascontiguousarray(negs, dtype=np.int64))
+        self.labels = torch.from_numpy(np.ascontiguousarray(labels, dtype=np.float32))
+        self.aux_users = torch.from_numpy(self.aux_user_table[users])
+        self.aux_items = torch.from_numpy(self.aux_item_table[items])
+
+    def _draw_negatives(self):
+        return self.sampler.sample(self.users_ps, self.num_ng, self.train_mat, self.rng)
+
+    def pop_sampler_stats(self):
+        """ Sampling cost of the negatives of the current epoch """
+        stats, self.sampler_stats = self.sampler_stats, None
+        return stats
+
+    def set_scorer(self, scorer):
+        """ Model scoring function of model-scored samplers, (users (n,), items (n, p)) -> (n, p) """
+        self.sampler.scorer = scorer
 
     def ng_sample(self):
         """negative sampling"""
         assert self.is_training, 'no need to sampling when testing'
 
-        self.features_ng = []
-        for x in self.features_ps:
-            u = x[0]
-            for t in range(self.num_ng):
-                j = np.random.randint(self.num_item)
-                while (u, j) in self.train_mat:
-                    j = np.random.randint(self.num_item)
-                self.features_ng.append([u, j])
+        if self._ng_future is not None:
+            users, items = self._ng_future.result()
+        else:
+            users, items = self._draw_negatives()
+        self.sampler_stats = self.sampler.pop_stats()
 
-        labels_ps = [1 for _ in range(len(self.features_ps))]
-        labels_ng = [0 for _ in range(len(self.features_ng))]
+        # sampling for the next epoch overlaps with training on this one
+        if self.ng_background:
+            if self._ng_executor is None:
+                self._ng_executor = ThreadPoolExecutor(max_workers=1)
+            self._ng_future = self._ng_executor.submit(self._draw_negatives)
 
-        self.features_fill = self.features_ps + self.features_ng
-        self.labels_fill = labels_ps + labels_ng
+        if self.pairwise:
+            # one row per positive, its num_ng negatives as a (num_ng,) neg_item
+            self._set_columns(self.users_ps, self.items_ps, items.reshape(len(self.users_ps), self.num_ng),
+                              np.ones(len(self.users_ps)))
+            return
+        # sampled negatives are their own neg_item, as in the original row layout
+        self._set_columns(np.concatenate([self.users_ps, users]),
+                          np.concatenate([self.items_ps, items]),
+                          np.concatenate([self.negs_ps, items]),
+                          np.concatenate([np.ones(len(self.users_ps)), np.zeros(len(users))]))
 
     def __len__(self):
         """length of data"""
-        return (self.num_ng + 1) * len(self.labels)
+        if self.pairwise:
+            return len(self.users_ps)
+        return (self.num_ng + 1) * len(self.users_ps)
 
     def __getitem__(self, idx):
-        features = self.features_fill if self.is_training else self.features_ps
-        labels = self.labels_fill if self.is_training else self.labels
-
-        # user, item, label
-        user_ = features[idx][0]
-        item_ = features[idx][1]
-        try:
-            if self.is_training:
-                neg_item = features[idx][2]
-                neg_item = torch.LongTensor([neg_item])
-            else:
-                neg_item = features[idx][1]
-                neg_item = torch.LongTensor([neg_item])
-        except:
-            neg_item = features[idx][1]
-            neg_item = torch.LongTensor([neg_item])
-        user = torch.LongTensor([user_])
-        item = torch.LongTensor([item_])
-        label_main = torch.FloatTensor([labels[idx]])
-
-        aux_user_ = torch.LongTensor([self.aux_user[user_]])
-        aux_item_ = torch.LongTensor([self.aux_item[item_]])
-
-        results = {'user_id':user,
-                   'item_id':item, 
-                   'neg_item':neg_item,
-                   'target_main':label_main,
-                   'target_user_aux' : aux_user_,
-                   'target_item_aux' : aux_item_}
-        
-        return results
\ No newline at end of file
+        if not np.isscalar(idx):
+            return self.get_batch(idx)
+        return self.get_batch([idx], batched=False)
+
+    def get_batch(self, indices, batched=True):
+        """ Slice a whole batch of samples with one gather per column. """
+        idx = torch.as_tensor(indices, dtype=torch.long)
+        results = {'user_id':self.users[idx],
+                   'item_id':self.items[idx], 
+                   'neg_item':self.negs[idx],
+                   'target_main':self.labels[idx],
+                   'target_user_aux' : self.aux_users[idx],
+                   'target_item_aux' : self.aux_items[idx]}
+        if batched:
+            # pairwise neg_item is already (b, num_ng)
+            results = {k: v.unsqueeze(1) if v.dim() == 1 else v for k, v in results.items()}
+        return results
+
+
+class StreamingDataset(data.IterableDataset):
+    def __init__(self, data_path_main_train : str, data_path_main_test : str,
+                 data_path_aux_user = None, data_path_aux_item = None,
+                 num_ng=0, is_training=True, chunk_size=65536, shuffle_chunks=8, sampler=None,
+                 pairwise=False):
+        super(StreamingDataset, self).__init__()
+        """ Training samples streamed in shuffled chunks from the binary cache.
+        """
+        """
+        data_path_main_train: main data 학습 데이터 경로
+        data_path_main_test: main data 평가 데이터 경로
+        data_path_aux_user: user auxiliary information 데이터 경로
+        data_path_aux_item: item auxiliary information 데이터 경로
+        num_ng: negative sampling 비율 (vs positive sample)
+        is_training: training 여부 (학습 데이터만 streaming)
+        chunk_size: 한 번에 읽는 positive sample 수
+        shuffle_chunks: shuffle buffer에서 함께 섞는 chunk 수
+        sampler: negative sampler 설정 (build_sampler 참고, 기본 uniform)
+        pairwise: positive 1개당 sample 1개, sampled negative는 (num_ng,) neg_item으로 (BPRLoss)
+
+        Every epoch the chunk order is permuted and each DataLoader worker
+        reads every num_workers-th chunk of it. A buffer of shuffle_chunks
+        chunks plus their negatives, drawn when the chunk is read, is
+        shuffled and cut into batches. Train rows and the interaction index
+        stay memory-mapped, so memory is bounded by
+        chunk_size * shuffle_chunks * (num_ng + 1) samples.
+        """
+        assert is_training, 'StreamingDataset only streams training data'
+        self.data_path_main_train = data_path_main_train
+        self.data_path_main_test = data_path_main_test
+
+        # compiles the binary cache on first use
+        train_data, _, user_num, item_num, train_mat = load_all(data_path_main_train, data_path_main_test)
+        self.aux_user, self.aux_item = load_aux_pair(data_path_aux_user, data_path_aux_item)
+        self.aux_user_table = aux_table(self.aux_user, user_num)
+        self.aux_item_table = aux_table(self.aux_item, item_num)
+
+        self.num_item = item_num
+        self.num_ng = num_ng
+        self.is_training = is_training
+        self.pairwise = pairwise
+        assert not (pairwise and num_ng < 1), 'pairwise sampling needs num_ng >= 1'
+        self.num_candidates = None
+        self.chunk_size = chunk_size
+        self.shuffle_chunks = shuffle_chunks
+        self.num_rows = len(train_data)
+        # with num_workers > 0 sampling statistics stay in the worker processes
+        self.sampler = build_sampler(sampler, item_num, train_mat)
+        self.rank, self.world_size = 0, 1
+        self.batch_size, self.shuffle, self.drop_last, self.num_workers = 1, True, False, 0
+
+        # seeded from the global numpy state so that fix_seed controls sampling
+        self.seed = int(np.random.randint(2 ** 31 - 1))
+        self.epoch = 0
+
+    def shard(self, rank, world_size):
+        """ Keep every world_size-th training row, starting at rank. """
+        """
+        Ranks share the seed, hence the chunk order, and get the same number
+        of rows, so every rank runs the same number of steps.
+        """
+        self.rank, self.world_size = rank, world_size
+        self.num_rows = self.num_rows // world_size
+        return self
+
+    def set_batching(self, batch_size, shuffle, drop_last, num_workers=0):
+        """ Batching of the DataLoader, see build_dataloader. """
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.num_workers = num_workers
+
+    def ng_sample(self):
+        """ Start the next epoch, negatives are drawn per chunk while streaming. """
+        self.epoch += 1
+
+    def pop_sampler_stats(self):
+        """ Sampling cost of the epoch streamed so far, in this process only """
+        return self.sampler.pop_stats()
+
+    def set_scorer(self, scorer):
+        """ Model scoring function of model-scored samplers, (users (n,), items (n, p)) -> (n, p) """
+        self.sampler.scorer = scorer
+
+    def _chunk_order(self):
+        num_chunks = -(-self.num_rows // self.chunk_size)
+        if not self.shuffle:
+            return np.arange(num_chunks)
+        # the same on every worker and rank, which then split it without overlap
+        return np.random.default_rng([self.seed, self.epoch]).permutation(num_chunks)
+
+    def _read_chunk(self, chunk, train_data, train_mat, rng):
+        start = chunk * self.chunk_size
+        stop = min(start + self.chunk_size, self.num_rows)
+        rows = np.asarray(train_data[start * self.world_size + self.rank:stop * self.world_size:self.world_size])
+        users, items = rows[:, 0], rows[:, 1]
+        negs = rows[:, 2] if rows.shape[1] > 2 else items
+        ng_users, ng_items = self.sampler.sample(users, self.num_ng, train_mat, rng)
+        if self.pairwise:
+            return users, items, ng_items.reshape(len(users), self.num_ng), np.ones(len(users), dtype=np.float32)
+        return (np.concatenate([users, ng_users]), np.concatenate([items, ng_items]),
+                np.concatenate([negs, ng_items]),
+                np.concatenate([np.ones(len(users), dtype=np.float32), np.zeros(len(ng_users), dtype=np.float32)]))
+
+    def _batch(self, users, items, negs, labels):
+        results = {'user_id':torch.from_numpy(users),
+                   'item_id':torch.from_numpy(items),
+                   'neg_item':torch.from_numpy(negs),
+                   'target_main':torch.from_numpy(labels),
+                   'target_user_aux' : torch.from_numpy(self.aux_user_table[users]),
+                   'target_item_aux' : torch.from_numpy(self.aux_item_table[items])}
+        return {k: v.unsqueeze(1) if v.dim() == 1 else v for k, v in results.items()}
+
+    def __len__(self):
+        """ Number of batches of this epoch over all workers. """
+        sizes = np.minimum(self.chunk_size, self.num_rows - np.arange(0, self.num_rows, self.chunk_size))
+        sizes = sizes[self._chunk_order()]
+        num_workers = max(self.num_workers, 1)
+        num_batches = 0
+        for worker in range(num_workers):
+            samples = int(sizes[worker::num_workers].sum()) * (1 if self.pairwise else self.num_ng + 1)
+            num_batches += samples // self.batch_size if self.drop_last else -(-samples // self.batch_size)
+        return num_batches
+
+    def __iter__(self):
+        info = data.get_worker_info()
+        worker, num_workers = (info.id, info.num_workers) if info is not None else (0, 1)
+        train_data, _, _, _, train_mat = load_all(self.data_path_main_train, self.data_path_main_test)
+        rng = np.random.default_rng([self.seed, self.epoch, self.rank, worker])
+        chunks = self._chunk_order()[worker::num_workers]
+
+        # samples short of a batch are carried into the next buffer
+        pending = [np.empty(0, dtype=np.int64)] * 2 + [np.empty((0, self.num_ng) if self.pairwise else 0, dtype=np.int64),
+                                                       np.empty(0, dtype=np.float32)]
+        for start in range(0, len(chunks), self.shuffle_chunks):
+            buffer = [self._read_chunk(c, train_data, train_mat, rng) for c in chunks[start:start + self.shuffle_chunks]]
+            buffer = [np.concatenate(column) for column in zip(*buffer)]
+            if self.shuffle:
+                order = rng.permutation(len(buffer[0]))
+                buffer = [column[order] for column in buffer]
+            buffer = [np.concatenate([p, b]) for p, b in zip(pending, buffer)]
+            num_full = len(buffer[0]) // self.batch_size * self.batch_size
+            for i in range(0, num_full, self.batch_size):
+                yield self._batch(*(column[i:i + self.batch_size] for column in buffer))
+            pending = [column[num_full:] for column in buffer]
+        if len(pending[0]) and not self.drop_last:
+            yield self._batch(*pending)
+
+
+def build_dataloader(dataset, batch_size=1, shuffle=False, drop_last=False, **kwargs):
+    """ DataLoader yielding whole batches sliced by the dataset itself. """
+    """
+    Datasets exposing get_batch receive a list of indices per batch from a
+    BatchSampler, skipping per-sample construction and the default collate.
+    (Not __getitems__: torch 2.x DataLoaders call that with a list of samples
+    expected back, and a plain DataLoader must keep working on these datasets.)
+    StreamingDataset batches its own stream. Other datasets fall back to a
+    plain DataLoader.
+    """
+    if isinstance(dataset, data.IterableDataset):
+        dataset.set_batching(batch_size, shuffle, drop_last, kwargs.get('num_workers', 0))
+        return data.DataLoader(dataset, batch_size=None, **kwargs)
+    if not hasattr(dataset, 'get_batch'):
+        return data.DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, drop_last=drop_last, **kwargs)
+    sampler = data.RandomSampler(dataset) if shuffle else data.SequentialSampler(dataset)
+    batch_sampler = data.BatchSampler(sampler, batch_size=batch_size, drop_last=drop_last)
+    return data.DataLoader(dataset, sampler=batch_sampler, batch_size=None, **kwargs)
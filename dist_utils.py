@@ -0,0 +1,102 @@
+import os
+import socket
+
+import torch
+import torch.distributed as dist
+from torch._utils import _flatten_dense_tensors, _unflatten_dense_tensors
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def free_port():
+    """
+    find a free local port for the spawn launcher's rendezvous
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def init_distributed(rank, world_size, backend = 'gloo'):
+    """
+    join the process group and split the CPU cores between the ranks
+    """
+    dist.init_process_group(backend, rank = rank, world_size = world_size)
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // world_size))
+
+
+def cleanup():
+    if is_distributed():
+        dist.destroy_process_group()
+
+
+def broadcast_object(obj):
+    """
+    rank 0's value of a picklable object on every rank
+    """
+    if not is_distributed():
+        return obj
+    objects = [obj]
+    dist.broadcast_object_list(objects, src = 0)
+    return objects[0]
+
+
+def broadcast_parameters(model):
+    """
+    copy rank 0's parameters and buffers to every rank
+    """
+    if not is_distributed():
+        return
+    for tensor in model.state_dict().values():
+        dist.broadcast(tensor, src = 0)
+
+
+def allreduce_gradients(model):
+    """
+    average the gradients of every rank with one all-reduce of a flat buffer
+
+    Parameters without a gradient this step (the unused ONCF branch, aux heads
+    left out of the loss) are skipped; they are the same on every rank.
+    """
+    world_size = get_world_size()
+    if world_size == 1:
+        return
+    params = [p for p in model.parameters() if p.grad is not None]
+    dense = [p.grad for p in params if not p.grad.is_sparse]
+    if dense:
+        flat = _flatten_dense_tensors(dense)
+        dist.all_reduce(flat)
+        flat /= world_size
+        for grad, reduced in zip(dense, _unflatten_dense_tensors(flat, dense)):
+            grad.copy_(reduced)
+    # row-sparse embedding gradients only carry the rows of each rank's batch
+    for p in params:
+        if p.grad.is_sparse:
+            p.grad = p.grad.coalesce()
+            dist.all_reduce(p.grad)
+            p.grad /= world_size
+
+
+def all_reduce_mean(values, count):
+    """
+    global mean of per-rank means `values` (1-D tensor) over `count` local items
+    """
+    if not is_distributed():
+        return values
+    total = torch.cat([values * count, values.new_tensor([count])])
+    dist.all_reduce(total)
+    return total[:-1] / total[-1]
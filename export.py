@@ -0,0 +1,179 @@
+import os
+import json
+import shutil
+import argparse
+from importlib import import_module
+
+import torch
+import numpy as np
+
+from model import Embedding
+from utils import load_config
+from graph import GRAPH_FILE, export_graph
+
+EXPORT_VERSION = 1
+
+
+def arg_parse():
+    """
+    parse arguments from a command
+    """
+    parser = argparse.ArgumentParser(description='inference-only export of a trained run')
+    parser.add_argument('saved_dir', type=str, help='run directory holding config.json and checkpoints')
+    parser.add_argument('--output', type=str, default=None, help='export directory (default: <saved_dir>_<dtype>)')
+    parser.add_argument('--checkpoint', type=str, default=None, help='checkpoint file (default: best checkpoint of saved_dir)')
+    parser.add_argument('--dtype', type=str, default='int8', choices=['int8', 'fp16', 'fp32'], help='embedding table storage')
+    parser.add_argument('--report', action='store_true', help='compare HR/NDCG of the export against the checkpoint')
+    parser.add_argument('--graph', action='store_true', help=f'also write a static-shape torch.export scoring graph ({GRAPH_FILE})')
+    parser.add_argument('--graph_users', type=int, default=64, help='users per call of the graph')
+    parser.add_argument('--graph_items', type=int, default=4096, help='items per call of the graph')
+    parser.add_argument('--device', type=str, default='cpu')
+    args = parser.parse_args()
+
+    return args
+
+
+def quantize_embeddings(model, dtype = 'int8'):
+    """ Store every embedding table of the model as int8 or fp16 ('fp32' keeps them) """
+    if dtype != 'fp32':
+        for module in model.modules():
+            if isinstance(module, Embedding):
+                module.quantize(dtype)
+    return model
+
+
+def export(model, cfgs, output, dtype = 'int8', graph = None):
+    """Write an inference-only artifact of a model
+
+    The directory holds export.json (model name, args, tensor index), the run
+    config and one .npy file per tensor of the state dict, embedding tables
+    quantized to dtype. Optimizer and scheduler state are left out.
+
+    Args:
+        model (torch model): trained ViT or ONCF
+        cfgs (namedtuple): run config
+        output (str): export directory, replaced if it exists
+        dtype (str, optional): 'int8', 'fp16' or 'fp32' embedding tables. Defaults to 'int8'.
+        graph (dict, optional): {'user_batch', 'item_chunk'} to also write graph.pt2, a scoring
+            graph of that static shape which loads without the model code. Defaults to None.
+    """
+    model = quantize_embeddings(model.cpu().eval(), dtype)
+    tmp_dir = f'{output}.tmp{os.getpid()}'
+    os.makedirs(tmp_dir, exist_ok=True)
+    tensors = {}
+    for name, tensor in model.state_dict().items():
+        array = tensor.detach().contiguous().numpy()
+        np.save(os.path.join(tmp_dir, f'{name}.npy'), array)
+        tensors[name] = {'dtype': str(array.dtype), 'shape': list(array.shape)}
+    if graph and not export_graph(model, os.path.join(tmp_dir, GRAPH_FILE), graph['user_batch'], graph['item_chunk']):
+        graph = None
+    meta = {'version': EXPORT_VERSION,
+            'model': {'name': cfgs.model.name, 'args': cfgs.model.args._asdict()},
+            'embedding_dtype': dtype,
+            'tensors': tensors,
+            'graph': dict(graph, file = GRAPH_FILE) if graph else None}
+    with open(os.path.join(tmp_dir, 'export.json'), 'w') as f:
+        json.dump(meta, f, indent=2)
+    with open(os.path.join(tmp_dir, 'config.json'), 'w') as f:
+        json.dump(_asdict(cfgs), f, indent=2)
+    if os.path.exists(output):
+        shutil.rmtree(output)
+    os.replace(tmp_dir, output)
+
+
+def _asdict(cfgs):
+    if hasattr(cfgs, '_asdict'):
+        return {k: _asdict(v) for k, v in cfgs._asdict().items()}
+    return cfgs
+
+
+def load_export(export_dir, device = 'cpu'):
+    """Rebuild a model from an export without unpickling anything
+
+    Tensors are memory-mapped (copy-on-write) from their .npy files and
+    assigned to a model built on the meta device, so the float32 tables are
+    never allocated.
+
+    Args:
+        export_dir (str): directory written by export
+        device (str, optional): device to load on. Defaults to 'cpu'.
+
+    Returns:
+        model in eval mode, run config
+    """
+    with open(os.path.join(export_dir, 'export.json'), 'r') as f:
+        meta = json.load(f)
+    assert meta['version'] == EXPORT_VERSION, f"unsupported export version {meta['version']}"
+    cfgs = load_config(os.path.join(export_dir, 'config.json'))
+
+    model_module = getattr(import_module("model"), meta['model']['name'])
+    with torch.device('meta'):
+        model = quantize_embeddings(model_module(**meta['model']['args']), meta['embedding_dtype'])
+    state_dict = {name: torch.from_numpy(np.load(os.path.join(export_dir, f'{name}.npy'), mmap_mode='c'))
+                  for name in meta['tensors']}
+    model.load_state_dict(state_dict, assign = True)
+    return model.to(device).eval(), cfgs
+
+
+def _dir_size(path):
+    return sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+
+
+def accuracy_report(saved_dir, export_dir, checkpoint_path = None, device = 'cpu'):
+    """HR/NDCG of an export next to the float32 checkpoint it came from
+
+    Both models go through train.validation on the run's validation set. The
+    report is printed and written to <export_dir>/accuracy.json.
+
+    Args:
+        saved_dir (str): run directory with config.json and checkpoints
+        export_dir (str): directory written by export
+        checkpoint_path (str, optional): checkpoint exported. Defaults to the best in saved_dir.
+        device (str, optional): device to evaluate on. Defaults to 'cpu'.
+
+    Returns:
+        dict: metrics and sizes of both models
+    """
+    from train import validation
+    from recommend import load_model, latest_checkpoint
+    from data_utils import CustomDataset, build_dataloader
+
+    checkpoint_path = checkpoint_path or latest_checkpoint(saved_dir)
+    fp32_model, cfgs = load_model(saved_dir, checkpoint_path, device)
+    compact_model, _ = load_export(export_dir, device)
+    val_dataset = CustomDataset(**cfgs.val_dataset.args._asdict())
+    val_dataloader = build_dataloader(val_dataset, **cfgs.val_dataloader.args._asdict())
+
+    report = {}
+    for name, model, size in (('fp32', fp32_model, os.path.getsize(checkpoint_path)),
+                              ('export', compact_model, _dir_size(export_dir))):
+        hr, ndcg = validation(0, 1, model, val_dataloader, cfgs.top_k, device)
+        report[name] = {'hr': hr, 'ndcg': ndcg, 'bytes': size}
+    report['delta'] = {'hr': report['export']['hr'] - report['fp32']['hr'],
+                       'ndcg': report['export']['ndcg'] - report['fp32']['ndcg']}
+
+    print(f"{'':<8}{'HR@' + str(cfgs.top_k):>12}{'NDCG@' + str(cfgs.top_k):>12}{'MB':>10}")
+    for name in ('fp32', 'export'):
+        r = report[name]
+        print(f"{name:<8}{r['hr']:>12.4f}{r['ndcg']:>12.4f}{r['bytes'] / 2 ** 20:>10.2f}")
+    print(f"{'delta':<8}{report['delta']['hr']:>12.4f}{report['delta']['ndcg']:>12.4f}")
+    with open(os.path.join(export_dir, 'accuracy.json'), 'w') as f:
+        json.dump(report, f, indent=2)
+    return report
+
+
+def main():
+    from recommend import load_model, latest_checkpoint
+
+    args = arg_parse()
+    checkpoint_path = args.checkpoint or latest_checkpoint(args.saved_dir)
+    output = args.output or f"{os.path.normpath(args.saved_dir)}_{args.dtype}"
+    model, cfgs = load_model(args.saved_dir, checkpoint_path)
+    graph = {'user_batch': args.graph_users, 'item_chunk': args.graph_items} if args.graph else None
+    export(model, cfgs, output, args.dtype, graph)
+    print(f'exported {checkpoint_path} to {output} ({_dir_size(output) / 2 ** 20:.2f} MB)')
+    if args.report:
+        accuracy_report(args.saved_dir, output, checkpoint_path, args.device)
+
+if __name__ == "__main__":
+    main()
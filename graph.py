@@ -0,0 +1,202 @@
+import os
+import json
+import time
+from contextlib import nullcontext
+
+import torch
+import torch.nn as nn
+
+GRAPH_FILE = 'graph.pt2'
+
+
+def _allclose(compiled, eager, atol, rtol):
+    if isinstance(eager, dict):
+        return all(_allclose(compiled[k], v, atol, rtol) for k, v in eager.items() if v is not None)
+    if isinstance(eager, (tuple, list)):
+        return all(_allclose(c, e, atol, rtol) for c, e in zip(compiled, eager))
+    return torch.allclose(compiled.float(), eager.float(), atol = atol, rtol = rtol)
+
+
+def _restore_eager(model, methods):
+    for name in methods:
+        model.__dict__.pop(name, None)
+
+
+def is_compiled(model):
+    """ True if compile_model replaced the methods of model """
+    return any(name in model.__dict__ for name in ('forward', 'score_pairs', 'score'))
+
+
+def compile_model(model, batch_size, num_candidates, val_users, heads = ('main', 'user', 'item'),
+                  num_neg = 1, autocast = nullcontext, device = 'cpu', mode = 'default', fullgraph = False,
+                  dynamic = False, atol = 1e-4, rtol = 1e-3):
+    """Compile the training and scoring methods of a model in place, eager on failure
+
+    torch.compile replaces the bound training method (forward for ViT,
+    score_pairs for ONCF) and score on the instance, so the state dict and
+    checkpoints are unchanged. The warm-up compiles both on random batches of
+    the training and validation shapes: the eval-mode outputs must match the
+    eager ones, then one training forward/backward is compiled under autocast
+    (gradients are cleared and the RNG state restored). Any error or mismatch
+    restores the eager methods.
+
+    Args:
+        model (torch model): ViT or ONCF
+        batch_size (int): training batch size
+        num_candidates (int): validation candidates per user
+        val_users (int): users per validation batch
+        heads (tuple, optional): ViT heads computed in training. Defaults to all.
+        num_neg (int, optional): ONCF negatives per positive in training. Defaults to 1.
+        autocast (callable, optional): autocast context of the training precision. Defaults to none.
+        device (str, optional): device of the model. Defaults to 'cpu'.
+        mode (str, optional): torch.compile mode. Defaults to 'default'.
+        fullgraph (bool, optional): fail on graph breaks instead of splitting. Defaults to False.
+        dynamic (bool, optional): dynamic shapes, static graphs per shape otherwise. Defaults to False.
+        atol, rtol (float, optional): tolerance of the compiled vs eager check.
+
+    Returns:
+        bool: True if the compiled methods are in use
+    """
+    train_method = 'score_pairs' if model.model_name == 'ONCF' else 'forward'
+    methods = (train_method, 'score')
+    num_user, num_item = model.emb.embed_user.num_embeddings, model.emb.embed_item.num_embeddings
+    was_training = model.training
+    start = time.perf_counter()
+    try:
+        with torch.random.fork_rng(devices = []):
+            user = torch.randint(num_user, (batch_size, 1), device = device)
+            item = torch.randint(num_item, (batch_size, 1), device = device)
+            neg_item = torch.randint(num_item, (batch_size, num_neg), device = device)
+            val_user = torch.randint(num_user, (val_users,), device = device)
+            val_item = torch.randint(num_item, (val_users, num_candidates), device = device)
+            if model.model_name == 'ONCF':
+                # GMF pretraining and the conv path are separate graphs
+                train_calls = [lambda: model.score_pairs(user, item, neg_item, True),
+                               lambda: model.score_pairs(user, item, neg_item, False)]
+            else:
+                train_calls = [lambda: model(user, item, outputs = heads)]
+
+            model.eval()
+            with torch.no_grad():
+                eager = [call() for call in train_calls]
+                eager_scores = model.score(model.encode_users(val_user), val_item)
+            for name in methods:
+                setattr(model, name, torch.compile(getattr(model, name), mode = mode,
+                                                   fullgraph = fullgraph, dynamic = dynamic))
+            with torch.no_grad():
+                compiled = [call() for call in train_calls]
+                compiled_scores = model.score(model.encode_users(val_user), val_item)
+            if not (_allclose(compiled, eager, atol, rtol) and _allclose(compiled_scores, eager_scores, atol, rtol)):
+                raise RuntimeError('compiled outputs differ from eager')
+
+            model.train()
+            for call in train_calls:
+                with autocast():
+                    outputs = call()
+                outputs = [v for v in (outputs.values() if isinstance(outputs, dict) else outputs) if v is not None]
+                sum(o.float().sum() for o in outputs).backward()
+            model.zero_grad(set_to_none = True)
+    except Exception as e:
+        _restore_eager(model, methods)
+        model.zero_grad(set_to_none = True)
+        print(f'torch.compile failed, training in eager mode: {e!r}')
+        return False
+    finally:
+        model.train(was_training)
+    print(f'compiled {model.model_name}.{train_method} and .score in {time.perf_counter() - start:.1f}s')
+    return True
+
+
+class ScoringGraph(nn.Module):
+    """ (n,) users x (c,) items -> (n, c) main scores, the model part exported for serving """
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, user, item):
+        scores = self.model.score(self.model.encode_users(user), item)
+        return scores['main'] if isinstance(scores, dict) else scores
+
+
+def export_graph(model, path, user_batch = 64, item_chunk = 4096, atol = 1e-4, rtol = 1e-3):
+    """Write a static-shape torch.export program of the model's scoring to path
+
+    The program maps user_batch users x item_chunk items to their scores and
+    holds the weights (quantized tables included), so it loads with
+    torch.export.load without the model code. It is checked against the eager
+    model before it is saved.
+
+    Args:
+        model (torch model): ViT or ONCF, on cpu
+        path (str): .pt2 file to write
+        user_batch (int, optional): users per call. Defaults to 64.
+        item_chunk (int, optional): items per call. Defaults to 4096.
+        atol, rtol (float, optional): tolerance of the exported vs eager check.
+
+    Returns:
+        bool: True if written, False (reason printed) if the export failed
+    """
+    graph = ScoringGraph(model.eval()).eval()
+    num_user, num_item = model.emb.embed_user.num_embeddings, model.emb.embed_item.num_embeddings
+    user = torch.arange(user_batch) % num_user
+    item = torch.arange(item_chunk) % num_item
+    try:
+        with torch.no_grad():
+            program = torch.export.export(graph, (user, item))
+            if not _allclose(program.module()(user, item), graph(user, item), atol, rtol):
+                raise RuntimeError('exported outputs differ from eager')
+        tmp_path = f'{os.path.splitext(path)[0]}.tmp{os.getpid()}.pt2'
+        torch.export.save(program, tmp_path)
+        os.replace(tmp_path, path)
+    except Exception as e:
+        print(f'graph export failed, serve with the eager model instead: {e!r}')
+        return False
+    return True
+
+
+class GraphScorer(nn.Module):
+    """ Scores any batch with an exported graph by padding users and items to its static shape
+
+    Exposes the encode_users / score interface of the models for scoring
+    every user against shared (c,) candidates, as recommend.recommend does.
+
+    Args:
+        path (str): graph.pt2 written by export_graph
+        model_name (str): 'ViT' or 'ONCF'
+        user_batch (int): users per call of the graph
+        item_chunk (int): items per call of the graph
+    """
+    def __init__(self, path, model_name, user_batch, item_chunk):
+        super().__init__()
+        self.graph = torch.export.load(path).module()
+        self.model_name = model_name
+        self.user_batch = user_batch
+        self.item_chunk = item_chunk
+
+    def encode_users(self, user_ids):
+        return user_ids.reshape(-1)
+
+    @torch.no_grad()
+    def score(self, users, item_ids):
+        assert item_ids.dim() == 1, 'the exported graph scores candidates shared by all users'
+        n, c = users.size(0), item_ids.size(0)
+        scores = torch.empty(n, c)
+        for u in range(0, n, self.user_batch):
+            user = users[u:u + self.user_batch]
+            user = torch.cat([user, user[:1].expand(self.user_batch - len(user))])
+            for i in range(0, c, self.item_chunk):
+                item = item_ids[i:i + self.item_chunk]
+                item = torch.cat([item, item[:1].expand(self.item_chunk - len(item))])
+                out = self.graph(user, item)
+                scores[u:u + self.user_batch, i:i + self.item_chunk] = out[:min(self.user_batch, n - u), :min(self.item_chunk, c - i)]
+        return scores
+
+
+def load_graph(export_dir):
+    """ GraphScorer of an export directory written with a graph """
+    with open(os.path.join(export_dir, 'export.json'), 'r') as f:
+        meta = json.load(f)
+    assert meta.get('graph'), f'{export_dir} has no exported graph, export it with --graph'
+    graph = meta['graph']
+    return GraphScorer(os.path.join(export_dir, graph['file']), meta['model']['name'],
+                       graph['user_batch'], graph['item_chunk'])
@@ -0,0 +1,61 @@
+import os
+
+import numpy as np
+
+from utils import load_config, load_torch_file
+from data_utils import load_all
+from model import grow_state_dict
+
+
+def base_checkpoint(cfg):
+    """ Checkpoint warm-started from: cfg.checkpoint, else the best (or latest) of cfg.base_run """
+    if getattr(cfg, 'checkpoint', ''):
+        return cfg.checkpoint
+    from recommend import latest_checkpoint
+    return latest_checkpoint(cfg.base_run)
+
+
+def delta_rows(train_data, old_train_mat):
+    """ Row ids of train_data whose interaction is not in old_train_mat, rows of new users/items included """
+    users, items = train_data[:, 0], train_data[:, 1]
+    known = (users < old_train_mat.num_user) & (items < old_train_mat.num_item)
+    new = ~known
+    new[known] = ~old_train_mat.contains(users[known], items[known])
+    return np.flatnonzero(new)
+
+
+def incremental_rows(train_dataset, cfg):
+    """Training rows of an incremental run: every new interaction plus a replay sample of old ones
+
+    New interactions are the rows of the dataset missing from the training
+    data of cfg.base_run, which must still be at the path of its config.
+    replay_ratio old rows per new row are drawn uniformly without replacement.
+
+    Args:
+        train_dataset (CustomDataset): training dataset of the current (grown) data
+        cfg (namedtuple): "incremental" config block
+
+    Returns:
+        np.ndarray: sorted row ids to keep
+    """
+    base_args = load_config(os.path.join(cfg.base_run, 'config.json')).train_dataset.args
+    _, _, _, _, old_train_mat = load_all(base_args.data_path_main_train, base_args.data_path_main_test)
+    rows = np.stack([train_dataset.users_ps, train_dataset.items_ps], axis = 1)
+    delta = delta_rows(rows, old_train_mat)
+    if len(delta) == 0:
+        raise ValueError(f'no new interactions since {cfg.base_run}, its training data must be the previous version')
+
+    old = np.setdiff1d(np.arange(len(rows)), delta, assume_unique = True)
+    num_replay = min(len(old), int(round(getattr(cfg, 'replay_ratio', 1.) * len(delta))))
+    replay = np.random.choice(old, num_replay, replace = False)
+    print(f'incremental: {len(delta)} new and {num_replay} replayed of {len(old)} old interactions')
+    return np.sort(np.concatenate([delta, replay]))
+
+
+def warm_start(model, cfg):
+    """ Load the base checkpoint into model, growing its tables for new users/items (cfg.init) """
+    checkpoint_path = base_checkpoint(cfg)
+    checkpoint = load_torch_file(checkpoint_path, map_location = 'cpu')
+    model.load_state_dict(grow_state_dict(checkpoint['model'], model, getattr(cfg, 'init', 'mean')))
+    print(f'incremental: warm start from {checkpoint_path}')
+    return model
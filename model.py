@@ -1,3 +1,5 @@
+import re
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -11,77 +13,251 @@ class Embedding(nn.Module):
                  item_num : int = 100, 
                  emb_size : int = 256, 
                  factor_num : int = 32,
-                 patch_size : int = 4):
+                 patch_size : int = 4,
+                 sparse : bool = False):
         super(Embedding, self).__init__()
-        device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-        self.embed_user = nn.ModuleList([nn.Embedding(user_num, factor_num).to(device) for _ in range(emb_size)])
-        self.embed_item = nn.ModuleList([nn.Embedding(item_num, factor_num).to(device) for _ in range(emb_size)])
+        self.emb_size = emb_size
+        self.factor_num = factor_num
+        # emb_size embedding layers fused into one table per side: row u holds
+        # the emb_size factor vectors of user u back to back
+        self.embed_user = nn.Embedding(user_num, emb_size * factor_num, sparse = sparse)
+        self.embed_item = nn.Embedding(item_num, emb_size * factor_num, sparse = sparse)
         self.projection = nn.Sequential(
             nn.Conv2d(emb_size, emb_size, kernel_size = patch_size, stride = patch_size),
             Rearrange('b e (h) (w) -> b (h w) e')
         )
         self.cls_token = nn.Parameter(torch.randn(1,1, emb_size))
         self.positions = nn.Parameter(torch.randn((factor_num // patch_size) ** 2 + 1, emb_size))
-    
-    def forward(self, user, item):
-        b, _ = user.size()
- 
-        embed_user = [layer(user) for layer in self.embed_user]
-        embed_user_ = [emb.permute(0, 2, 1) for emb in embed_user]
 
-        embed_item = [layer(item) for layer in self.embed_item]
+    def embed_users(self, user):
+        return self.embed_user(user).view(-1, self.emb_size, self.factor_num)
+
+    def embed_items(self, item):
+        return self.embed_item(item).view(-1, self.emb_size, self.factor_num)
 
-        embed_outer = [torch.unsqueeze(torch.bmm(emb_u, emb_i), 1) for emb_u, emb_i in zip(embed_user_, embed_item)]
-        embed_outer = torch.cat(embed_outer, dim = 1)
+    def outer(self, embed_user, embed_item):
+        # (b, emb_size, factor_num, 1) x (b, emb_size, 1, factor_num)
+        return torch.matmul(embed_user.unsqueeze(-1), embed_item.unsqueeze(-2))
 
+    def tokens(self, embed_outer):
+        b = embed_outer.size(0)
         x = self.projection(embed_outer)
         cls_tokens = repeat(self.cls_token, '() n e -> b n e', b=b)
         x = torch.cat([cls_tokens, x], dim=1)
         x += self.positions
-
-        embed_user = torch.cat(embed_user, dim = 1)
-        embed_item = torch.cat(embed_item, dim = 1)
+        return x
+    
+    def forward(self, user, item, outputs = ('tokens', 'outer')):
+        """ Only the requested outputs among 'tokens' and 'outer' are computed, the others are None """
+        embed_user = self.embed_users(user)
+        embed_item = self.embed_items(item)
+        x, embed_outer = None, None
+        if 'tokens' in outputs or 'outer' in outputs:
+            embed_outer = self.outer(embed_user, embed_item)
+        if 'tokens' in outputs:
+            x = self.tokens(embed_outer)
 
         return x, embed_user, embed_item, embed_outer
 
+    def quantize(self, dtype = 'int8'):
+        """ Swap both tables for QuantizedEmbedding copies, for inference only """
+        self.embed_user = QuantizedEmbedding.from_float(self.embed_user.weight.detach(), dtype)
+        self.embed_item = QuantizedEmbedding.from_float(self.embed_item.weight.detach(), dtype)
+        return self
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        convert_state_dict(state_dict, prefix)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+
+class QuantizedEmbedding(nn.Module):
+    """ Embedding table stored in int8 with per-row scales, or in fp16
+
+    Only the gathered rows are dequantized to float32, so scoring reads the
+    compact table directly.
+
+    Args:
+        num_embeddings (int): number of rows
+        embedding_dim (int): size of a row
+        dtype (str, optional): 'int8' (symmetric, scale = max |row| / 127) or 'fp16'. Defaults to 'int8'.
+    """
+    def __init__(self, num_embeddings : int, embedding_dim : int, dtype : str = 'int8'):
+        super(QuantizedEmbedding, self).__init__()
+        assert dtype in ('int8', 'fp16'), f'unsupported embedding dtype {dtype}'
+        self.num_embeddings = num_embeddings
+        self.embedding_dim = embedding_dim
+        self.dtype = dtype
+        storage = torch.int8 if dtype == 'int8' else torch.float16
+        self.register_buffer('weight_q', torch.zeros(num_embeddings, embedding_dim, dtype = storage))
+        self.register_buffer('scale', torch.ones(num_embeddings) if dtype == 'int8' else None)
+
+    @classmethod
+    def from_float(cls, weight, dtype = 'int8'):
+        table = cls(weight.size(0), weight.size(1), dtype)
+        if dtype == 'int8':
+            scale = weight.abs().amax(dim = 1) / 127
+            scale = torch.where(scale > 0, scale, torch.ones_like(scale))
+            table.weight_q = torch.round(weight / scale.unsqueeze(1)).clamp(-127, 127).to(torch.int8)
+            table.scale = scale.float()
+        else:
+            table.weight_q = weight.to(torch.float16)
+        return table
+
+    def dequantize(self):
+        """ float32 copy of the whole table """
+        return self(torch.arange(self.num_embeddings, device = self.weight_q.device))
+
+    def forward(self, ids):
+        rows = self.weight_q[ids].float()
+        if self.scale is not None:
+            rows = rows * self.scale[ids].unsqueeze(-1)
+        return rows
+
+
+def convert_state_dict(state_dict, prefix = ''):
+    """Convert checkpoints saved with one nn.Embedding per layer to the fused layout
+
+    `{prefix}embed_user.N.weight` (num, factor_num) keys are concatenated along
+    the factor axis into a single `{prefix}embed_user.weight` (num, emb_size*factor_num).
+    The state dict is modified in place and returned.
+
+    Args:
+        state_dict (dict): state dict of Embedding (or a model holding it)
+        prefix (str, optional): key prefix of the Embedding module. Defaults to ''.
+    """
+    for side in ('embed_user', 'embed_item'):
+        pattern = re.compile(rf'^{re.escape(prefix)}{side}\.(\d+)\.weight$')
+        layers = {}
+        for key in list(state_dict.keys()):
+            match = pattern.match(key)
+            if match:
+                layers[int(match.group(1))] = state_dict.pop(key)
+        if layers:
+            weights = [layers[i] for i in sorted(layers)]
+            state_dict[f'{prefix}{side}.weight'] = torch.cat(weights, dim = 1)
+    return state_dict
+
+
+def grow_state_dict(state_dict, model, init = 'mean'):
+    """Fit the embedding tables of a checkpoint to a model with more users/items
+
+    Rows of the checkpoint are copied to the same ids of the model's tables,
+    rows of the new ids are initialized by init: 'mean' (the mean trained
+    row), 'normal' (N(0, std of the trained rows)) or 'zeros'. The state dict
+    is modified in place and returned.
+
+    Args:
+        state_dict (dict): state dict of a ViT or ONCF checkpoint
+        model (torch model): model of the same architecture, tables at least as large
+        init (str, optional): initialization of the new rows. Defaults to 'mean'.
+    """
+    assert init in ('mean', 'normal', 'zeros'), f'unknown init {init}'
+    convert_state_dict(state_dict, 'emb.')
+    target = model.state_dict()
+    for key in ('emb.embed_user.weight', 'emb.embed_item.weight'):
+        old, new = state_dict[key], target[key]
+        if old.shape == new.shape:
+            continue
+        assert old.size(1) == new.size(1) and old.size(0) < new.size(0), \
+            f'{key}: cannot grow {tuple(old.shape)} to {tuple(new.shape)}'
+        grown = torch.empty_like(new)
+        grown[:old.size(0)] = old
+        if init == 'mean':
+            grown[old.size(0):] = old.mean(dim = 0)
+        elif init == 'normal':
+            grown[old.size(0):] = torch.randn_like(grown[old.size(0):]) * old.std()
+        else:
+            grown[old.size(0):] = 0
+        state_dict[key] = grown
+    return state_dict
+
 
 class MultiHeadAttention(nn.Module):
     def __init__(self,
                  emb_size : int = 256,
                  num_heads : int = 8, 
-                 dropout : float = 0.):
+                 dropout : float = 0.,
+                 attention : str = 'sdpa',
+                 attention_scaling : str = 'post_softmax'):
+        """ Multi-head self attention with a fused QKV projection
+
+        Args:
+            emb_size (int, optional): embedding size. Defaults to 256.
+            num_heads (int, optional): number of heads. Defaults to 8.
+            dropout (float, optional): attention dropout rate. Defaults to 0.
+            attention (str, optional): 'sdpa' for F.scaled_dot_product_attention, 'eager' for
+                explicit einsum + softmax. Defaults to 'sdpa'.
+            attention_scaling (str, optional): 'post_softmax' divides the attention weights by
+                sqrt(emb_size) after the softmax, as the original implementation did, so existing
+                checkpoints score identically. 'standard' scales the logits by 1/sqrt(head_dim).
+                Defaults to 'post_softmax'.
+        """
         super().__init__()
+        assert attention in ('sdpa', 'eager'), f'unknown attention {attention}'
+        assert attention_scaling in ('post_softmax', 'standard'), f'unknown attention_scaling {attention_scaling}'
         self.emb_size = emb_size
         self.num_heads = num_heads if emb_size >= 8 else emb_size
+        self.dropout = dropout
+        self.attention = attention if hasattr(F, 'scaled_dot_product_attention') else 'eager'
+        self.attention_scaling = attention_scaling
 
-        self.keys = nn.Linear(emb_size, emb_size)
-        self.queries = nn.Linear(emb_size, emb_size)
-        self.values = nn.Linear(emb_size, emb_size)
+        # queries, keys and values in one projection
+        self.qkv = nn.Linear(emb_size, 3 * emb_size)
 
         self.att_drop = nn.Dropout(dropout)
         self.projection = nn.Linear(emb_size, emb_size)
         
     def forward(self, x , mask = None):
-        queries = rearrange(self.queries(x), "b n (h d) -> b h n d", h = self.num_heads)
-        keys = rearrange(self.keys(x), "b n (h d) -> b h n d", h = self.num_heads)
-        values = rearrange(self.values(x), "b n (h d) -> b h n d", h = self.num_heads)
-
-        # sum up over the last axis
-        energy = torch.einsum('bhqd, bhkd -> bhqk', queries, keys) # batch, num_heads, query_len, key_len
-        if mask is not None:
-            fill_value = torch.finfo(torch.float32).min
-            energy.mask_fill(~mask, fill_value)
-            
-        scaling = self.emb_size ** (1/2)
-        att = F.softmax(energy, dim=-1) / scaling
-        att = self.att_drop(att)
-
-        # sum up over the third axis
-        out = torch.einsum('bhal, bhlv -> bhav ', att, values)
-        out = rearrange(out, "b h n d -> b n (h d)")
+        b, n, e = x.size()
+        qkv = self.qkv(x).view(b, n, 3, self.num_heads, e // self.num_heads).permute(2, 0, 3, 1, 4)
+        queries, keys, values = qkv[0], qkv[1], qkv[2] # batch, num_heads, len, head_dim
+
+        if self.attention_scaling == 'post_softmax':
+            # softmax(qk) / s @ v == softmax(qk) @ (v / s)
+            values = values / self.emb_size ** (1/2)
+            scale = 1.
+        else:
+            scale = (e // self.num_heads) ** (-1/2)
+
+        # under cpu autocast the einsum path runs on bf16 matmuls, the cpu flash
+        # attention kernel (backward especially) is slower there than in fp32
+        if self.attention == 'sdpa' and not (x.is_cpu and torch.is_autocast_enabled('cpu')):
+            out = F.scaled_dot_product_attention(queries, keys, values, attn_mask = mask,
+                                                 dropout_p = self.dropout if self.training else 0.,
+                                                 scale = scale)
+        else:
+            energy = torch.einsum('bhqd, bhkd -> bhqk', queries, keys) * scale # batch, num_heads, query_len, key_len
+            if mask is not None:
+                fill_value = torch.finfo(energy.dtype).min
+                energy = energy.masked_fill(~mask, fill_value)
+            att = F.softmax(energy, dim=-1)
+            att = self.att_drop(att)
+            out = torch.einsum('bhal, bhlv -> bhav ', att, values)
+
+        out = out.transpose(1, 2).reshape(b, n, e)
         out = self.projection(out)
         return out
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints from before the fused projection hold separate queries/keys/values
+        for param in ('weight', 'bias'):
+            names = [f'{prefix}{name}.{param}' for name in ('queries', 'keys', 'values')]
+            if all(name in state_dict for name in names):
+                state_dict[f'{prefix}qkv.{param}'] = torch.cat([state_dict.pop(name) for name in names], dim = 0)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+
+def fp32(module, x):
+    """ module(x) in float32 outside any autocast region, for heads and normalization """
+    with torch.autocast(device_type = x.device.type, enabled = False):
+        return module(x.float())
+
+
+class LayerNorm(nn.LayerNorm):
+    """ nn.LayerNorm that stays in float32 under autocast """
+    def forward(self, x):
+        return fp32(super().forward, x)
+
 
 class FeedForwardBlock(nn.Sequential):
     def __init__(self, 
@@ -118,14 +294,14 @@ class TransformerEncoderBlock(nn.Sequential):
         super().__init__(
             ResidualAdd(
                 nn.Sequential(
-                    nn.LayerNorm(emb_size),
+                    LayerNorm(emb_size),
                     MultiHeadAttention(emb_size, **kwargs),
                     nn.Dropout(drop_p)
                 )
              ),
             ResidualAdd(
                 nn.Sequential(
-                    nn.LayerNorm(emb_size),
+                    LayerNorm(emb_size),
                     FeedForwardBlock(emb_size, expansion=forward_expansion, drop_p=forward_drop_p),
                     nn.Dropout(drop_p)
                 )
@@ -141,7 +317,7 @@ class ClassificationHead(nn.Sequential):
     def __init__(self, emb_size : int = 256, out_size : int = 1):
         super().__init__(
             Reduce('b n e -> b e', reduction = 'mean'),
-            nn.LayerNorm(emb_size),
+            LayerNorm(emb_size),
             nn.Linear(emb_size, out_size)
         )
 
@@ -177,6 +353,7 @@ class ViT(nn.Module):
                  user_out : int = 100,
                  item_out : int = 100,
                  dropout : float = 0.1,
+                 sparse : bool = False,
                  **kwargs):
         """ NCF Framework Using Transformer Structure
 
@@ -191,6 +368,7 @@ class ViT(nn.Module):
             user_out (int, optional) : output size of user auxiliary classifier. Defaults to 100.
             item_out (int, optional) : output size of item auxiliary classifier. Defaults to 100.
             dropout (float, optional) : dropout rate
+            sparse (bool, optional) : sparse gradients for the user/item embedding tables. Defaults to False.
         """
         super().__init__()
 
@@ -201,7 +379,8 @@ class ViT(nn.Module):
                              item_num = item_num, 
                              emb_size = emb_size, 
                              factor_num = factor_num,
-                             patch_size = patch_size)
+                             patch_size = patch_size,
+                             sparse = sparse)
         self.enc = TransformerEncoder(depth = depth, emb_size = emb_size, forward_drop_p=dropout, drop_p=dropout, **kwargs)
         self.cls = ClassificationHead(emb_size = emb_size, out_size = 1)
 
@@ -214,34 +393,72 @@ class ViT(nn.Module):
             # self.enc_item = TransformerEncoder(depth_item, emb_size = emb_size, **kwargs)
             # self.cls_item = ClassificationHead(emb_size = emb_size, out_size = item_out)
         
-    def forward(self, user, item):
+    def forward(self, user, item, outputs = ('main', 'user', 'item')):
+        """ Heads not in outputs (or without a classifier) are skipped and returned as None """
         b, _ = user.size()
-        x, embed_user, embed_item, embed_outer = self.emb(user, item)
-        x = self.enc(x)
-        x = self.cls(x)
+        x, embed_user, embed_item, embed_outer = self.emb(user, item, ('tokens',) if 'main' in outputs else ())
 
         result = {
-            'main' : x,
+            'main' : None,
             'user' : None,
             'item' : None
         }
 
-        if self.user_out:
+        # under autocast the encoder runs in low precision, the heads in float32
+        if 'main' in outputs:
+            x = self.enc(x)
+            x = fp32(self.cls, x)
+            result['main'] = x
+
+        if self.user_out and 'user' in outputs:
             x_user = embed_user.view(b,-1)
-            x_user = self.aux_user(x_user)
+            x_user = fp32(self.aux_user, x_user)
             #x_user = self.enc_user(embed_user)
             #x_user = self.cls_user(x_user)
             result['user'] = x_user
         
-        if self.item_out:
+        if self.item_out and 'item' in outputs:
             x_item = embed_item.view(b,-1)
-            x_item = self.aux_item(x_item)
+            x_item = fp32(self.aux_item, x_item)
             #x_item = self.enc_item(embed_item)
             #x_item = self.cls_item(x_item)
             result['item'] = x_item
 
         return result
 
+    @torch.no_grad()
+    def encode_users(self, user_ids):
+        """ User side of inference scoring, computed once per user. Returns a (n, emb_size, factor_num) cache. """
+        return self.emb.embed_users(user_ids.reshape(-1))
+
+    @torch.no_grad()
+    def score(self, user_cache, item_ids, outputs = ('main',)):
+        """Score every user in user_cache against its candidate items
+
+        Args:
+            user_cache (tensor): output of encode_users for n users
+            item_ids (tensor): (c,) candidates shared by all users or (n, c) per user
+            outputs (tuple, optional): heads to run among 'main', 'user', 'item'. Defaults to ('main',).
+
+        Returns:
+            dict: 'main' (n, c) scores, 'user' (n, user_out) and 'item' (n, c, item_out) logits or None
+        """
+        n, c = user_cache.size(0), item_ids.size(-1)
+        embed_item = self.emb.embed_items(item_ids).view(*item_ids.shape, self.emb.emb_size, self.emb.factor_num).expand(n, c, -1, -1)
+        embed_user = user_cache.unsqueeze(1).expand_as(embed_item)
+
+        result = {'main' : None, 'user' : None, 'item' : None}
+        if 'main' in outputs:
+            embed_outer = self.emb.outer(embed_user.reshape(n * c, *user_cache.shape[1:]),
+                                         embed_item.reshape(n * c, *user_cache.shape[1:]))
+            x = self.enc(self.emb.tokens(embed_outer))
+            result['main'] = self.cls(x).view(n, c)
+        if 'user' in outputs and self.user_out:
+            result['user'] = self.aux_user(user_cache.reshape(n, -1))
+        if 'item' in outputs and self.item_out:
+            result['item'] = self.aux_item(embed_item.reshape(n, c, -1))
+        return result
+
 class ONCF(nn.Module):
     model_name='ONCF'
     def __init__(self,
@@ -255,6 +472,7 @@ class ONCF(nn.Module):
                  user_out : int = 100,
                  item_out : int = 100,
                  dropout : float = 0.1,
+                 sparse : bool = False,
                  **kwargs):
         super().__init__()
         self.emb_size = emb_size
@@ -262,7 +480,8 @@ class ONCF(nn.Module):
                              item_num = item_num, 
                              emb_size = emb_size, 
                              factor_num = factor_num,
-                             patch_size = patch_size)
+                             patch_size = patch_size,
+                             sparse = sparse)
         self.dropout = dropout
         conv = [nn.Conv2d(emb_size, 32, kernel_size=2, stride=2), nn.ReLU()]
         output_dim = factor_num//2
@@ -277,18 +496,91 @@ class ONCF(nn.Module):
 
     def forward(self, user, item, is_pretrain):
         b, _ = user.size()
-        x, embed_user, embed_item, embed_outer = self.emb(user, item)
+        # pretrain only needs the embeddings, fine-tuning only their outer product
+        x, embed_user, embed_item, embed_outer = self.emb(user, item, () if is_pretrain else ('outer',))
         
         if is_pretrain:
             x = torch.mul(embed_user, embed_item)
             x = x.view(b, -1)
-            output = self.affine(x)
+            output = fp32(self.affine, x)
         else:
             x = self.conv(embed_outer)
             x = x.view(b, -1)
-            x = nn.Dropout(self.dropout)(x)
-            output = self.cls(x)
+            x = F.dropout(x, self.dropout, self.training)
+            output = fp32(self.cls, x)
         return output
 
+    def score_pairs(self, user, pos_item, neg_item, is_pretrain = False):
+        """Training scores of positive and negative items in one pass
+
+        The user embeddings are looked up once and every (user, item) pair of
+        the positives and negatives goes through the GMF or conv path as a
+        single batch.
+
+        Args:
+            user (tensor): (b, 1) user ids
+            pos_item (tensor): (b, 1) positive item ids
+            neg_item (tensor): (b, k) negative item ids, k >= 1 per positive
+            is_pretrain (bool, optional): score with the GMF path. Defaults to False.
+
+        Returns:
+            tensor, tensor: (b, 1) positive and (b, k) negative scores, broadcastable for BPRLoss
+        """
+        b = user.size(0)
+        items = torch.cat([pos_item.view(b, -1), neg_item.view(b, -1)], dim = 1)
+        n = items.size(1)
+        embed_user = self.emb.embed_users(user.view(-1)).unsqueeze(1)
+        embed_item = self.emb.embed_items(items).view(b, n, *embed_user.shape[2:])
+
+        if is_pretrain:
+            output = fp32(self.affine, torch.mul(embed_user, embed_item).view(b, n, -1)).view(b, n)
+        else:
+            embed_outer = self.emb.outer(embed_user.expand_as(embed_item).reshape(b * n, *embed_user.shape[2:]),
+                                         embed_item.reshape(b * n, *embed_user.shape[2:]))
+            x = self.conv(embed_outer).view(b * n, -1)
+            x = F.dropout(x, self.dropout, self.training)
+            output = fp32(self.cls, x).view(b, n)
+        return output[:, :1], output[:, 1:]
+
+    @torch.no_grad()
+    def encode_users(self, user_ids, is_pretrain = False):
+        """ User side of inference scoring, computed once per user
+
+        In the pretrain path the affine weights are folded into the user
+        embedding, so scoring reduces to a dot product with the item embedding.
+        """
+        embed_user = self.emb.embed_users(user_ids.reshape(-1))
+        if is_pretrain:
+            return embed_user.reshape(embed_user.size(0), -1) * self.affine.weight
+        return embed_user
+
+    @torch.no_grad()
+    def score(self, user_cache, item_ids, is_pretrain = False):
+        """Score every user in user_cache against its candidate items
+
+        Args:
+            user_cache (tensor): output of encode_users for n users, same is_pretrain
+            item_ids (tensor): (c,) candidates shared by all users or (n, c) per user
+            is_pretrain (bool, optional): score with the GMF path. Defaults to False.
+
+        Returns:
+            tensor: (n, c) scores
+        """
+        n, c = user_cache.size(0), item_ids.size(-1)
+        embed_item = self.emb.embed_items(item_ids).view(*item_ids.shape, self.emb.emb_size, self.emb.factor_num)
+
+        if is_pretrain:
+            embed_item = embed_item.reshape(*item_ids.shape, -1)
+            if item_ids.dim() == 1:
+                return user_cache @ embed_item.t() + self.affine.bias
+            return torch.einsum('nk,nck->nc', user_cache, embed_item) + self.affine.bias
+
+        embed_item = embed_item.expand(n, c, -1, -1)
+        embed_user = user_cache.unsqueeze(1).expand_as(embed_item)
+        embed_outer = self.emb.outer(embed_user.reshape(n * c, *user_cache.shape[1:]),
+                                     embed_item.reshape(n * c, *user_cache.shape[1:]))
+        x = self.conv(embed_outer).view(n * c, -1)
+        return self.cls(x).view(n, c)
+
 
                  
\ No newline at end of file
@@ -0,0 +1,75 @@
+from importlib import import_module
+
+import torch
+import torch.nn as nn
+
+
+class CompositeOptimizer(torch.optim.Optimizer):
+    """ Several optimizers stepped together as one
+
+    param_groups are the sub-optimizers' own group dicts, so schedulers that
+    change group['lr'] reach every sub-optimizer. state_dict holds one entry
+    per sub-optimizer.
+
+    Args:
+        optimizers (dict): name -> torch optimizer, over disjoint parameters
+    """
+    def __init__(self, optimizers):
+        params = [p for opt in optimizers.values() for group in opt.param_groups for p in group['params']]
+        super().__init__(params, {})
+        self.optimizers = optimizers
+        self.param_groups = [group for opt in optimizers.values() for group in opt.param_groups]
+
+    @torch.no_grad()
+    def step(self, closure = None):
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
+        for opt in self.optimizers.values():
+            opt.step()
+        return loss
+
+    def state_dict(self):
+        return {name: opt.state_dict() for name, opt in self.optimizers.items()}
+
+    def load_state_dict(self, state_dict):
+        for name, opt in self.optimizers.items():
+            opt.load_state_dict(state_dict[name])
+
+
+def sparse_parameters(model):
+    """ Weights of the embedding tables built with sparse gradients """
+    return [m.weight for m in model.modules() if isinstance(m, nn.Embedding) and m.sparse]
+
+
+def build_optimizer(model, cfg):
+    """Optimizer from the "optimizer" config
+
+    Dense parameters use cfg.name/cfg.args. If the model has sparse embedding
+    tables, their weights go to a row-sparse optimizer given by the optional
+    cfg.sparse block (SparseAdam with the dense lr by default), which only
+    updates and keeps moments for the rows touched by each batch.
+
+    Args:
+        model (torch model): model to optimize
+        cfg (namedtuple): optimizer config with name, args and optional sparse
+
+    Returns:
+        torch optimizer
+    """
+    optimizer_module = getattr(import_module("torch.optim"), cfg.name)
+    sparse = sparse_parameters(model)
+    if not sparse:
+        return optimizer_module(model.parameters(), **cfg.args._asdict())
+
+    sparse_ids = {id(p) for p in sparse}
+    dense = [p for p in model.parameters() if id(p) not in sparse_ids]
+    if hasattr(cfg, 'sparse'):
+        sparse_module = getattr(import_module("torch.optim"), cfg.sparse.name)
+        sparse_args = cfg.sparse.args._asdict()
+    else:
+        sparse_module = torch.optim.SparseAdam
+        sparse_args = {'lr': cfg.args.lr}
+    return CompositeOptimizer({'dense': optimizer_module(dense, **cfg.args._asdict()),
+                               'sparse': sparse_module(sparse, **sparse_args)})
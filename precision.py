@@ -0,0 +1,59 @@
+from contextlib import nullcontext
+
+import torch
+
+# name -> (device type, autocast dtype)
+PRECISIONS = {
+    'fp32': (None, None),
+    'bf16-cpu': ('cpu', torch.bfloat16),
+    'fp16-cuda': ('cuda', torch.float16),
+}
+
+
+def resolve_precision(cfgs, device):
+    """ Precision name of a config, the legacy "fp16" flag maps to fp16-cuda on a cuda device """
+    if hasattr(cfgs, 'precision'):
+        return cfgs.precision
+    if getattr(cfgs, 'fp16', False):
+        if torch.device(device).type == 'cuda':
+            return 'fp16-cuda'
+        print('"fp16" only applies to cuda devices, training in fp32')
+    return 'fp32'
+
+
+class Precision:
+    """ Autocast region and loss scaling of a training precision
+
+    The forward pass runs under `autocast()`, the backward pass and the
+    optimizer step go through `backward` and `step`, so one training step
+    serves every precision. bf16 has the exponent range of fp32 and needs no
+    loss scaling; fp16 scales the loss with a GradScaler.
+
+    Args:
+        name (str, optional): 'fp32', 'bf16-cpu' or 'fp16-cuda'. Defaults to 'fp32'.
+        device (str or torch.device, optional): training device. Defaults to 'cpu'.
+    """
+    def __init__(self, name = 'fp32', device = 'cpu'):
+        assert name in PRECISIONS, f'unknown precision {name}, expected one of {list(PRECISIONS)}'
+        self.name = name
+        self.device_type, self.dtype = PRECISIONS[name]
+        if self.device_type:
+            assert torch.device(device).type == self.device_type, f'{name} needs a {self.device_type} device, got {device}'
+        self.scaler = torch.amp.GradScaler('cuda') if name == 'fp16-cuda' else None
+
+    def autocast(self):
+        if self.dtype is None:
+            return nullcontext()
+        return torch.autocast(device_type = self.device_type, dtype = self.dtype)
+
+    def backward(self, loss):
+        if self.scaler:
+            loss = self.scaler.scale(loss)
+        loss.backward()
+
+    def step(self, optimizer):
+        if self.scaler:
+            self.scaler.step(optimizer)
+            self.scaler.update()
+        else:
+            optimizer.step()
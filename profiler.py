@@ -0,0 +1,165 @@
+import os
+import json
+import time
+import resource
+from contextlib import contextmanager, nullcontext
+
+import torch
+
+_PAGE_MB = os.sysconf('SC_PAGE_SIZE') / 2 ** 20 if hasattr(os, 'sysconf') else 0.
+
+
+def rss_mb():
+    """ Current resident set size, the lifetime peak where /proc is unavailable """
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * _PAGE_MB
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class TrainProfiler:
+    """ Per-phase wall time, throughput and memory of the training loop
+
+    Phases are timed with `phase(name)` blocks, the forward of every direct
+    child of the model (Embedding, TransformerEncoder, AuxClassifier, ...) and
+    of its embedding tables with forward hooks. RSS is sampled at every step
+    for the peak of the epoch. At each epoch end one JSON line is appended to
+    `{saved_dir}/metrics.jsonl` and a summary table is printed.
+
+    Args:
+        saved_dir (str): run directory for metrics.jsonl and traces
+        device (torch.device): training device, synchronized around phases on cuda
+        enabled (bool, optional): if False every call is a no-op. Defaults to True.
+        trace_steps (int, optional): steps recorded with torch.profiler, 0 to disable. Defaults to 0.
+        trace_wait (int, optional): steps skipped before the trace window. Defaults to 5.
+    """
+    def __init__(self, saved_dir, device, enabled = True, trace_steps = 0, trace_wait = 5):
+        self.saved_dir = saved_dir
+        self.enabled = enabled
+        self.cuda = torch.device(device).type == 'cuda'
+        self.trace = None
+        self.hooks = []
+        self._reset()
+
+        if enabled and trace_steps:
+            self.trace = torch.profiler.profile(
+                schedule = torch.profiler.schedule(wait = trace_wait, warmup = 1, active = trace_steps, repeat = 1),
+                on_trace_ready = torch.profiler.tensorboard_trace_handler(os.path.join(saved_dir, 'trace')),
+                record_shapes = True, profile_memory = True)
+            self.trace.start()
+
+    def _reset(self):
+        self.times = {}
+        self.samples = 0
+        self.steps = 0
+        self.peak_rss = rss_mb()
+        self.start = time.perf_counter()
+        if self.cuda:
+            torch.cuda.reset_peak_memory_stats()
+
+    def _sync(self):
+        if self.cuda:
+            torch.cuda.synchronize()
+
+    def _add(self, name, elapsed):
+        self.times[name] = self.times.get(name, 0.) + elapsed
+
+    @contextmanager
+    def _timed(self, name):
+        self._sync()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._sync()
+            self._add(name, time.perf_counter() - start)
+
+    def phase(self, name):
+        """ Context manager timing one phase of a step """
+        return self._timed(name) if self.enabled else nullcontext()
+
+    def attach(self, model, compiled = False):
+        """ Time the training-mode forward of each direct child module of model and of its embedding tables
+
+        Hooks do not fire inside compiled graphs, so a compiled model is only
+        timed by the phases around it.
+        """
+        if not self.enabled:
+            return
+        if compiled:
+            print('compiled model: per-module forward timings are off, see the forward phase')
+            return
+        modules = list(model.named_children())
+        # ONCF.score_pairs looks rows up without Embedding.forward, the tables are timed on their own
+        if hasattr(model, 'emb'):
+            modules += [(f'emb.{name}', module) for name, module in model.emb.named_children() if name.startswith('embed_')]
+        for name, module in modules:
+            starts = []
+            def pre_hook(module, inputs, starts = starts):
+                if module.training:
+                    self._sync()
+                    starts.append(time.perf_counter())
+            def post_hook(module, inputs, outputs, name = name, starts = starts):
+                if not module.training:
+                    return
+                self._sync()
+                self._add(f'forward/{name}', time.perf_counter() - starts.pop())
+            self.hooks.append(module.register_forward_pre_hook(pre_hook))
+            self.hooks.append(module.register_forward_hook(post_hook))
+
+    def iterate(self, loader):
+        """ Iterate loader, timing each batch fetch as the 'data' phase """
+        iterator = iter(loader)
+        while True:
+            with self.phase('data'):
+                try:
+                    batch = next(iterator)
+                except StopIteration:
+                    return
+            yield batch
+
+    def step(self, batch_size):
+        """ Mark the end of a training step """
+        if not self.enabled:
+            return
+        self.samples += batch_size
+        self.steps += 1
+        self.peak_rss = max(self.peak_rss, rss_mb())
+        if self.trace is not None:
+            self.trace.step()
+
+    def epoch_end(self, epoch, **extra):
+        """ Write the epoch record (with extra fields) to metrics.jsonl, print a summary and reset """
+        if not self.enabled:
+            return
+        total = time.perf_counter() - self.start
+        record = {'epoch': epoch,
+                  'wall_time': total,
+                  'steps': self.steps,
+                  'samples': self.samples,
+                  'samples_per_sec': self.samples / total if total else 0.,
+                  'peak_rss_mb': max(self.peak_rss, rss_mb()),
+                  'phases': self.times}
+        record.update(extra)
+        if self.cuda:
+            record['peak_allocated_mb'] = torch.cuda.max_memory_allocated() / 2 ** 20
+        with open(os.path.join(self.saved_dir, 'metrics.jsonl'), 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+        print(f"{'phase':<24}{'time (s)':>12}{'share':>10}")
+        for name, elapsed in sorted(self.times.items(), key = lambda x: -x[1]):
+            print(f"{name:<24}{elapsed:>12.3f}{elapsed / total:>10.1%}")
+        summary = f"epoch {epoch}: {total:.2f}s, {record['samples_per_sec']:.1f} samples/s, peak RSS {record['peak_rss_mb']:.0f} MB"
+        if self.cuda:
+            summary += f", peak allocated {record['peak_allocated_mb']:.0f} MB"
+        print(summary)
+        self._reset()
+
+    def close(self):
+        for hook in self.hooks:
+            hook.remove()
+        self.hooks = []
+        if self.trace is not None:
+            self.trace.stop()
+            self.trace = None
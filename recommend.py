@@ -0,0 +1,256 @@
+import os
+import glob
+import json
+import argparse
+import multiprocessing as mp
+from importlib import import_module
+
+import torch
+import numpy as np
+
+from utils import load_config, load_torch_file
+from data_utils import load_all
+from export import load_export
+from graph import load_graph
+from checkpoint import best_checkpoint
+from retrieval import VectorIndex, two_stage
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+
+def arg_parse():
+    """
+    parse arguments from a command
+    """
+    parser = argparse.ArgumentParser(description='top-K recommendation from a trained run')
+    parser.add_argument('saved_dir', type=str, help='run directory holding config.json and checkpoints, or an export directory')
+    parser.add_argument('--users', type=str, default=None, help='text file with one user id per line (default: all users)')
+    parser.add_argument('--output', type=str, default='recommendations.bin', help='.bin (raw records + .json header) or .parquet')
+    parser.add_argument('--checkpoint', type=str, default=None, help='checkpoint file (default: best in the checkpoint index, else latest .pt in saved_dir)')
+    parser.add_argument('--top_k', type=int, default=10)
+    parser.add_argument('--user_batch', type=int, default=64, help='users scored together')
+    parser.add_argument('--item_chunk', type=int, default=4096, help='items scored at once, bounds memory to user_batch x item_chunk')
+    parser.add_argument('--workers', type=int, default=1, help='scoring processes')
+    parser.add_argument('--graph', action='store_true', help='score with the exported graph of an export directory (export.py --graph)')
+    parser.add_argument('--retrieval_index', type=str, default=None, help='re-rank candidates of this index (retrieval.py build) instead of scoring every item')
+    parser.add_argument('--candidates', type=int, default=200, help='retrieved items re-ranked per user')
+    parser.add_argument('--nprobe', type=int, default=16, help='IVF clusters searched per user')
+    args = parser.parse_args()
+
+    return args
+
+
+def latest_checkpoint(saved_dir):
+    """ Best checkpoint of the run's index, else the latest .pt file of the directory """
+    best = best_checkpoint(saved_dir)
+    if best is not None:
+        return best
+    checkpoints = glob.glob(os.path.join(saved_dir, '*.pt'))
+    assert checkpoints, f'no checkpoint in {saved_dir}'
+    # runs without an index only wrote checkpoints on improvement, so the latest is the best
+    return max(checkpoints, key=os.path.getmtime)
+
+
+def load_model(saved_dir, checkpoint_path = None, device = 'cpu', graph = False):
+    """Rebuild the model of a run and load its weights
+
+    Args:
+        saved_dir (str): run directory with the copied config.json, or a directory written by export.py
+        checkpoint_path (str, optional): checkpoint to load. Defaults to latest_checkpoint(saved_dir).
+        device (str, optional): device to load on. Defaults to 'cpu'.
+        graph (bool, optional): load the exported scoring graph of an export directory instead. Defaults to False.
+
+    Returns:
+        model in eval mode, run config
+    """
+    if graph:
+        return load_graph(saved_dir), load_config(os.path.join(saved_dir, 'config.json'))
+    if os.path.exists(os.path.join(saved_dir, 'export.json')):
+        return load_export(saved_dir, device)
+    cfgs = load_config(os.path.join(saved_dir, 'config.json'))
+    if checkpoint_path is None:
+        checkpoint_path = latest_checkpoint(saved_dir)
+
+    model_module = getattr(import_module("model"), cfgs.model.name)
+    model = model_module(**cfgs.model.args._asdict())
+    checkpoint = load_torch_file(checkpoint_path, map_location=device)
+    model.load_state_dict(checkpoint['model'])
+    return model.to(device).eval(), cfgs
+
+
+def read_users(path, batch_size):
+    """ Stream user ids from a text file in batches """
+    batch = []
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                batch.append(int(line))
+            if len(batch) == batch_size:
+                yield np.asarray(batch, dtype=np.int64)
+                batch = []
+    if batch:
+        yield np.asarray(batch, dtype=np.int64)
+
+
+def recommend(model, users, train_mat, top_k = 10, item_chunk = 4096, num_item = None):
+    """Top-K unseen items for a batch of users
+
+    Items are scored in chunks of item_chunk against the cached user side and
+    merged into a running top-K, so memory stays at len(users) x item_chunk.
+
+    Args:
+        model (torch model): ViT or ONCF in eval mode
+        users (np.ndarray): user ids
+        train_mat (InteractionIndex): training interactions to exclude
+        top_k (int, optional): number of items per user. Defaults to 10.
+        item_chunk (int, optional): items scored per step. Defaults to 4096.
+        num_item (int, optional): catalog size. Defaults to the item embedding size.
+
+    Returns:
+        (n, top_k) item ids and scores as numpy arrays
+    """
+    device = next(model.parameters()).device
+    num_item = num_item or model.emb.embed_item.num_embeddings
+    rows, seen = train_mat.pairs(users)
+    rows, seen = torch.from_numpy(rows).to(device), torch.from_numpy(seen).to(device)
+
+    user_cache = model.encode_users(torch.from_numpy(users).to(device))
+    best_scores = torch.full((len(users), 0), float('-inf'), device=device)
+    best_items = torch.zeros((len(users), 0), dtype=torch.long, device=device)
+    for start in range(0, num_item, item_chunk):
+        items = torch.arange(start, min(start + item_chunk, num_item), device=device)
+        scores = model.score(user_cache, items)
+        scores = scores['main'] if isinstance(scores, dict) else scores
+
+        in_chunk = (seen >= start) & (seen < start + len(items))
+        scores[rows[in_chunk], seen[in_chunk] - start] = float('-inf')
+
+        best_scores = torch.cat([best_scores, scores], dim=1)
+        best_items = torch.cat([best_items, items.expand(len(users), -1)], dim=1)
+        best_scores, idx = torch.topk(best_scores, min(top_k, best_scores.size(1)), dim=1)
+        best_items = torch.gather(best_items, 1, idx)
+    return best_items.cpu().numpy(), best_scores.cpu().numpy()
+
+
+class RecommendationWriter:
+    """ Append-only writer of (user, items[k], scores[k]) records
+
+    `.parquet` outputs need pyarrow. Anything else is written as packed
+    little-endian records readable with np.fromfile(path, dtype) using the
+    dtype described in the `<path>.json` header.
+    """
+    def __init__(self, path, top_k):
+        self.path = path
+        self.top_k = top_k
+        self.count = 0
+        self.parquet = path.endswith('.parquet')
+        if self.parquet:
+            assert pa is not None, 'pyarrow is required for parquet output'
+            self.schema = pa.schema([('user', pa.int32()),
+                                     ('items', pa.list_(pa.int32())),
+                                     ('scores', pa.list_(pa.float32()))])
+            self.writer = pq.ParquetWriter(path, self.schema)
+        else:
+            self.dtype = np.dtype([('user', '<i4'), ('items', '<i4', (top_k,)), ('scores', '<f4', (top_k,))])
+            self.file = open(path, 'wb')
+
+    def write(self, users, items, scores):
+        if self.parquet:
+            table = pa.table({'user': users.astype(np.int32),
+                              'items': items.astype(np.int32).tolist(),
+                              'scores': scores.astype(np.float32).tolist()}, schema=self.schema)
+            self.writer.write_table(table)
+        else:
+            records = np.empty(len(users), dtype=self.dtype)
+            records['user'], records['items'], records['scores'] = users, items, scores
+            records.tofile(self.file)
+        self.count += len(users)
+
+    def close(self):
+        if self.parquet:
+            self.writer.close()
+            return
+        self.file.close()
+        with open(f'{self.path}.json', 'w') as f:
+            json.dump({'count': self.count, 'top_k': self.top_k,
+                       'dtype': [('user', '<i4'), ('items', '<i4', [self.top_k]), ('scores', '<f4', [self.top_k])]}, f)
+
+
+_worker = {}
+
+def _init_worker(saved_dir, checkpoint_path, top_k, item_chunk, num_threads, retrieval = None, graph = False):
+    torch.set_num_threads(num_threads)
+    model, cfgs = load_model(saved_dir, checkpoint_path, graph = graph)
+    args = cfgs.train_dataset.args
+    _, _, _, _, train_mat = load_all(args.data_path_main_train, args.data_path_main_test)
+    _worker.update(model=model, train_mat=train_mat, top_k=top_k, item_chunk=item_chunk,
+                   num_item=cfgs.model.args.item_num, retrieval=retrieval)
+    if retrieval:
+        _worker['index'] = VectorIndex.load(retrieval['index'])
+
+def _score_batch(users):
+    if _worker['retrieval']:
+        items, scores = two_stage(_worker['model'], _worker['index'], users, _worker['train_mat'], _worker['top_k'],
+                                  _worker['retrieval']['candidates'], _worker['retrieval']['nprobe'])
+        return users, items, scores
+    items, scores = recommend(_worker['model'], users, _worker['train_mat'], _worker['top_k'],
+                              _worker['item_chunk'], _worker['num_item'])
+    return users, items, scores
+
+
+def run(saved_dir, output, users_path = None, checkpoint_path = None, top_k = 10,
+        user_batch = 64, item_chunk = 4096, workers = 1, retrieval = None, graph = False):
+    """Write top-K recommendations for a stream of users
+
+    Args:
+        saved_dir (str): run directory with config.json and checkpoints
+        output (str): output path, .parquet or packed binary
+        users_path (str, optional): user id file. Defaults to every user of the model.
+        checkpoint_path (str, optional): checkpoint to load. Defaults to the best in saved_dir.
+        top_k (int, optional): items per user. Defaults to 10.
+        user_batch (int, optional): users per scoring task. Defaults to 64.
+        item_chunk (int, optional): items scored at once. Defaults to 4096.
+        workers (int, optional): scoring processes sharing the CPU cores. Defaults to 1.
+        retrieval (dict, optional): {'index': dir, 'candidates': int, 'nprobe': int} to re-rank
+            retrieved candidates only. Defaults to scoring every item.
+        graph (bool, optional): score with the exported graph of an export directory. Defaults to False.
+    """
+    assert not (graph and retrieval), 'the exported graph scores every item, it does not re-rank retrieved candidates'
+
+    cfgs = load_config(os.path.join(saved_dir, 'config.json'))
+    if users_path:
+        batches = read_users(users_path, user_batch)
+    else:
+        all_users = np.arange(cfgs.model.args.user_num, dtype=np.int64)
+        batches = (all_users[i:i + user_batch] for i in range(0, len(all_users), user_batch))
+
+    num_threads = max(1, (os.cpu_count() or 1) // workers)
+    init_args = (saved_dir, checkpoint_path, top_k, item_chunk, num_threads, retrieval, graph)
+    writer = RecommendationWriter(output, top_k)
+    if workers > 1:
+        with mp.get_context('spawn').Pool(workers, initializer=_init_worker, initargs=init_args) as pool:
+            for result in pool.imap(_score_batch, batches):
+                writer.write(*result)
+    else:
+        _init_worker(*init_args)
+        for users in batches:
+            writer.write(*_score_batch(users))
+    writer.close()
+    print(f'{writer.count} users written to {output}')
+
+
+def main():
+    args = arg_parse()
+    retrieval = None
+    if args.retrieval_index:
+        retrieval = {'index': args.retrieval_index, 'candidates': args.candidates, 'nprobe': args.nprobe}
+    run(args.saved_dir, args.output, args.users, args.checkpoint, args.top_k,
+        args.user_batch, args.item_chunk, args.workers, retrieval, args.graph)
+
+if __name__ == "__main__":
+    main()
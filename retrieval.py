@@ -0,0 +1,298 @@
+import os
+import json
+import time
+import shutil
+import argparse
+
+import torch
+import numpy as np
+
+INDEX_VERSION = 1
+
+
+def arg_parse():
+    """
+    parse arguments from a command
+    """
+    parser = argparse.ArgumentParser(description='GMF candidate retrieval in front of the full model')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    build = sub.add_parser('build', help='export the GMF vectors of an ONCF run as a vector index')
+    build.add_argument('saved_dir', type=str, help='ONCF run (or export) directory')
+    build.add_argument('--output', type=str, required=True, help='index directory')
+    build.add_argument('--checkpoint', type=str, default=None)
+    build.add_argument('--index', type=str, default='ivf', choices=['exact', 'ivf'])
+    build.add_argument('--nlist', type=int, default=256, help='IVF clusters')
+    build.add_argument('--iters', type=int, default=20, help='k-means iterations')
+
+    report = sub.add_parser('report', help='recall and throughput of two-stage vs full scoring')
+    report.add_argument('saved_dir', type=str, help='run (or export) directory of the ranking model')
+    report.add_argument('--index', type=str, required=True, help='index directory written by build')
+    report.add_argument('--checkpoint', type=str, default=None)
+    report.add_argument('--users', type=int, default=1000, help='users sampled for the report')
+    report.add_argument('--top_k', type=int, default=10)
+    report.add_argument('--candidates', type=int, default=200, help='retrieved items re-ranked per user')
+    report.add_argument('--nprobe', type=int, default=16, help='IVF clusters searched per user')
+    report.add_argument('--user_batch', type=int, default=64)
+    report.add_argument('--item_chunk', type=int, default=4096)
+    report.add_argument('--output', type=str, default=None, help='JSON report path')
+    return parser.parse_args()
+
+
+def _merge_topk(best_scores, best_items, scores, items, k):
+    """ Running top-k of (n, k) best and (n, m) new scores/items """
+    scores = np.concatenate([best_scores, scores], axis=1)
+    items = np.concatenate([best_items, np.broadcast_to(items, scores[:, best_scores.shape[1]:].shape)], axis=1)
+    if scores.shape[1] > k:
+        idx = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        scores = np.take_along_axis(scores, idx, axis=1)
+        items = np.take_along_axis(items, idx, axis=1)
+    return scores, items
+
+
+def kmeans(x, nlist, iters = 20, seed = 0, chunk_size = 65536):
+    """ Lloyd k-means in NumPy, returns (nlist, d) centroids and the (n,) assignment """
+    rng = np.random.default_rng(seed)
+    centroids = x[rng.choice(len(x), nlist, replace = False)].copy()
+    for _ in range(iters):
+        assign = np.concatenate([
+            # argmin |x - c|^2 = argmin |c|^2 - 2 x.c
+            np.argmin((centroids ** 2).sum(1) - 2 * x[s:s + chunk_size] @ centroids.T, axis = 1)
+            for s in range(0, len(x), chunk_size)])
+        counts = np.bincount(assign, minlength = nlist)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, x)
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty, None]
+        # empty clusters restart from random points
+        centroids[empty] = x[rng.choice(len(x), empty.sum(), replace = False)]
+    return centroids, assign
+
+
+class VectorIndex:
+    """ Maximum inner product search over GMF item vectors
+
+    Scores are `user_vector . item_vector + bias`, the ONCF pretrain (GMF)
+    score. Exact search scores every item in blocks with a running top-K. IVF
+    search groups items by k-means cluster and only scores the nprobe
+    clusters whose centroid scores highest for the user.
+
+    Args:
+        users (np.ndarray): (num_user, d) user vectors, affine weights folded in
+        items (np.ndarray): (num_item, d) item vectors
+        bias (float): score offset
+        centroids (np.ndarray, optional): (nlist, d) IVF centroids, None for exact search
+        order (np.ndarray, optional): item ids sorted by cluster
+        offsets (np.ndarray, optional): (nlist + 1,) start of each cluster in order
+    """
+    def __init__(self, users, items, bias = 0., centroids = None, order = None, offsets = None):
+        self.users = users
+        self.items = items
+        self.bias = float(bias)
+        self.centroids = centroids
+        self.order = order
+        self.offsets = offsets
+
+    @classmethod
+    def from_model(cls, model, index = 'ivf', nlist = 256, iters = 20):
+        """ Index of the GMF vectors of a trained ONCF """
+        assert model.model_name == 'ONCF', 'retrieval vectors come from the ONCF pretrain (GMF) path'
+        with torch.no_grad():
+            users = model.encode_users(torch.arange(model.emb.embed_user.num_embeddings), is_pretrain = True)
+            items = model.emb.embed_items(torch.arange(model.emb.embed_item.num_embeddings))
+        users = users.float().cpu().numpy()
+        items = items.reshape(items.size(0), -1).float().cpu().numpy()
+        bias = model.affine.bias.item()
+        if index == 'exact':
+            return cls(users, items, bias)
+        centroids, assign = kmeans(items, min(nlist, len(items)), iters)
+        order = np.argsort(assign, kind = 'stable')
+        offsets = np.zeros(len(centroids) + 1, dtype = np.int64)
+        np.cumsum(np.bincount(assign, minlength = len(centroids)), out = offsets[1:])
+        return cls(users, items, bias, centroids, order, offsets)
+
+    @property
+    def kind(self):
+        return 'exact' if self.centroids is None else 'ivf'
+
+    def save(self, path):
+        tmp_dir = f'{path}.tmp{os.getpid()}'
+        os.makedirs(tmp_dir, exist_ok = True)
+        arrays = {'users': self.users, 'items': self.items}
+        if self.centroids is not None:
+            arrays.update(centroids = self.centroids, order = self.order, offsets = self.offsets)
+        for name, arr in arrays.items():
+            np.save(os.path.join(tmp_dir, f'{name}.npy'), arr)
+        with open(os.path.join(tmp_dir, 'index.json'), 'w') as f:
+            json.dump({'version': INDEX_VERSION, 'kind': self.kind, 'bias': self.bias,
+                       'num_user': len(self.users), 'num_item': len(self.items)}, f, indent = 2)
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.replace(tmp_dir, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(os.path.join(path, 'index.json'), 'r') as f:
+            meta = json.load(f)
+        assert meta['version'] == INDEX_VERSION, f"unsupported index version {meta['version']}"
+        names = ['users', 'items'] + (['centroids', 'order', 'offsets'] if meta['kind'] == 'ivf' else [])
+        arrays = {name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode = 'r') for name in names}
+        return cls(bias = meta['bias'], **arrays)
+
+    def search(self, users, k, train_mat = None, nprobe = 16, item_chunk = 65536):
+        """Top-k unseen items of a batch of users
+
+        Args:
+            users (np.ndarray): user ids
+            k (int): items per user
+            train_mat (InteractionIndex, optional): training interactions to exclude
+            nprobe (int, optional): IVF clusters searched per user. Defaults to 16.
+            item_chunk (int, optional): items scored per block in exact search. Defaults to 65536.
+
+        Returns:
+            (n, k) item ids and scores sorted by score, -inf scores (item -1) where fewer than k items were found
+        """
+        users = np.asarray(users, dtype = np.int64)
+        query = np.asarray(self.users[users])
+        # both modes pad to k, also when the catalog has fewer than k items
+        best_scores = np.full((len(users), k), -np.inf, dtype = np.float32)
+        best_items = np.full((len(users), k), -1, dtype = np.int64)
+
+        if self.centroids is None:
+            rows, seen = train_mat.pairs(users) if train_mat is not None else (np.empty(0, int), np.empty(0, int))
+            for start in range(0, len(self.items), item_chunk):
+                items = np.arange(start, min(start + item_chunk, len(self.items)))
+                scores = query @ self.items[start:start + len(items)].T + self.bias
+                in_chunk = (seen >= start) & (seen < start + len(items))
+                scores[rows[in_chunk], seen[in_chunk] - start] = -np.inf
+                best_scores, best_items = _merge_topk(best_scores, best_items, scores, items, k)
+        else:
+            nprobe = min(nprobe, len(self.centroids))
+            probe = np.argpartition(-(query @ self.centroids.T), nprobe - 1, axis = 1)[:, :nprobe]
+            # one matmul per probed cluster over the users probing it
+            for c in np.unique(probe):
+                items = np.asarray(self.order[self.offsets[c]:self.offsets[c + 1]])
+                rows = np.flatnonzero((probe == c).any(axis = 1))
+                if len(items) == 0:
+                    continue
+                scores = query[rows] @ self.items[items].T + self.bias
+                if train_mat is not None:
+                    seen = train_mat.contains(np.repeat(users[rows], len(items)), np.tile(items, len(rows)))
+                    scores[seen.reshape(len(rows), len(items))] = -np.inf
+                best_scores[rows], best_items[rows] = _merge_topk(best_scores[rows], best_items[rows], scores, items, k)
+
+        order = np.argsort(-best_scores, axis = 1, kind = 'stable')
+        best_scores = np.take_along_axis(best_scores, order, axis = 1)
+        best_items = np.take_along_axis(best_items, order, axis = 1)
+        best_items[~np.isfinite(best_scores)] = -1
+        return best_items, best_scores
+
+
+def two_stage(model, index, users, train_mat, top_k = 10, candidates = 200, nprobe = 16):
+    """Top-K unseen items: GMF retrieval of candidates, re-ranked by the full model
+
+    Args:
+        model (torch model): ViT or ONCF in eval mode
+        index (VectorIndex): retrieval index
+        users (np.ndarray): user ids
+        train_mat (InteractionIndex): training interactions to exclude
+        top_k (int, optional): number of items per user. Defaults to 10.
+        candidates (int, optional): retrieved items per user. Defaults to 200.
+        nprobe (int, optional): IVF clusters searched per user. Defaults to 16.
+
+    Returns:
+        (n, top_k) item ids and scores as numpy arrays, item -1 and score -inf
+        where fewer than top_k candidates were retrieved
+    """
+    device = next(model.parameters()).device
+    items, retrieved = index.search(users, candidates, train_mat, nprobe)
+    valid = torch.from_numpy(np.isfinite(retrieved)).to(device)
+
+    user_cache = model.encode_users(torch.from_numpy(users).to(device))
+    scores = model.score(user_cache, torch.from_numpy(np.maximum(items, 0)).to(device))
+    scores = scores if model.model_name == 'ONCF' else scores['main']
+    scores = scores.masked_fill(~valid, float('-inf'))
+
+    best_scores, idx = torch.topk(scores, min(top_k, scores.size(1)), dim = 1)
+    best_items = torch.gather(torch.from_numpy(items).to(device), 1, idx)
+    best_items, best_scores = best_items.cpu().numpy(), best_scores.cpu().numpy()
+    if best_items.shape[1] < top_k:
+        pad = top_k - best_items.shape[1]
+        best_items = np.pad(best_items, ((0, 0), (0, pad)), constant_values = -1)
+        best_scores = np.pad(best_scores, ((0, 0), (0, pad)), constant_values = -np.inf)
+    return best_items, best_scores
+
+
+def report(model, index, train_mat, users, top_k = 10, candidates = 200, nprobe = 16,
+           user_batch = 64, item_chunk = 4096):
+    """Recall and throughput of two-stage retrieval against scoring every item
+
+    Args:
+        model (torch model): ranking model in eval mode
+        index (VectorIndex): retrieval index
+        train_mat (InteractionIndex): training interactions to exclude
+        users (np.ndarray): users to evaluate
+        top_k, candidates, nprobe: see two_stage
+        user_batch (int, optional): users scored together. Defaults to 64.
+        item_chunk (int, optional): items per step of full scoring. Defaults to 4096.
+
+    Returns:
+        dict: recall@top_k of the final list and of the candidates, users/sec of both pipelines
+    """
+    from recommend import recommend
+
+    batches = [users[i:i + user_batch] for i in range(0, len(users), user_batch)]
+    start = time.perf_counter()
+    full = np.concatenate([recommend(model, b, train_mat, top_k, item_chunk)[0] for b in batches])
+    full_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    ranked = np.concatenate([two_stage(model, index, b, train_mat, top_k, candidates, nprobe)[0] for b in batches])
+    two_stage_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    retrieved = np.concatenate([index.search(b, candidates, train_mat, nprobe)[0] for b in batches])
+    retrieval_time = time.perf_counter() - start
+
+    def recall(found):
+        return float(np.mean([len(np.intersect1d(f, t)) / len(t) for f, t in zip(found, full)]))
+
+    return {'users': len(users), 'top_k': top_k, 'candidates': candidates, 'index': index.kind,
+            'nprobe': nprobe if index.kind == 'ivf' else None,
+            'recall': recall(ranked),
+            'candidate_recall': recall(retrieved),
+            'full_users_per_sec': len(users) / full_time,
+            'two_stage_users_per_sec': len(users) / two_stage_time,
+            'retrieval_users_per_sec': len(users) / retrieval_time,
+            'speedup': full_time / two_stage_time}
+
+
+def main():
+    from recommend import load_model
+    from data_utils import load_all
+
+    args = arg_parse()
+    model, cfgs = load_model(args.saved_dir, args.checkpoint)
+    if args.command == 'build':
+        index = VectorIndex.from_model(model, args.index, args.nlist, args.iters)
+        index.save(args.output)
+        print(f'{index.kind} index of {len(index.items)} items written to {args.output}')
+        return
+
+    index = VectorIndex.load(args.index)
+    data_args = cfgs.train_dataset.args
+    _, _, _, _, train_mat = load_all(data_args.data_path_main_train, data_args.data_path_main_test)
+    users = np.random.default_rng(0).choice(cfgs.model.args.user_num, min(args.users, cfgs.model.args.user_num),
+                                            replace = False)
+    result = report(model, index, train_mat, users, args.top_k, args.candidates, args.nprobe,
+                    args.user_batch, args.item_chunk)
+    print(f"recall@{args.top_k} vs full scoring: {result['recall']:.4f} "
+          f"(candidates: {result['candidate_recall']:.4f})")
+    print(f"users/sec: full {result['full_users_per_sec']:.1f}, two-stage {result['two_stage_users_per_sec']:.1f} "
+          f"(retrieval only {result['retrieval_users_per_sec']:.1f}), speedup x{result['speedup']:.2f}")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent = 2)
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1 @@
-python train.py train_config1.json
-python train.py train_config2.json
-python train.py train_config3.json
-python train.py train_config4.json
\ No newline at end of file
+python sweep.py sweep_config_vit.json
@@ -0,0 +1,204 @@
+import os
+import sys
+import json
+import time
+import argparse
+import itertools
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import torch
+
+from utils import load_config, fix_seed
+
+# datasets built once in the parent, inherited by the forked trial processes
+_shared = {}
+
+
+def arg_parse():
+    """
+    parse arguments from a command
+    """
+    parser = argparse.ArgumentParser(description='parallel hyperparameter sweep of train.py')
+    parser.add_argument('cfg', type=str, help='sweep config json')
+    args = parser.parse_args()
+
+    return args
+
+
+def set_path(cfg, path, value):
+    """ Set a dotted key path ('optimizer.args.lr') of a nested config dict """
+    *parents, key = path.split('.')
+    for p in parents:
+        cfg = cfg[p]
+    cfg[key] = value
+
+
+def sample_value(spec, rng):
+    """ One random value of a search space entry """
+    """
+    spec: list of choices, {"uniform": [low, high]}, {"loguniform": [low, high]}
+          or {"randint": [low, high]} (high inclusive)
+    """
+    if isinstance(spec, list):
+        return spec[rng.integers(len(spec))]
+    (kind, (low, high)), = spec.items()
+    if kind == 'uniform':
+        return float(rng.uniform(low, high))
+    if kind == 'loguniform':
+        return float(np.exp(rng.uniform(np.log(low), np.log(high))))
+    if kind == 'randint':
+        return int(rng.integers(low, high + 1))
+    raise ValueError(f'unknown search space entry {spec}')
+
+
+def trial_params(sweep):
+    """ Parameter dict of every trial, grid product or random samples """
+    space = sweep['space']
+    if sweep.get('search', 'grid') == 'grid':
+        assert all(isinstance(v, list) for v in space.values()), 'grid search needs a list of values per key'
+        return [dict(zip(space, values)) for values in itertools.product(*space.values())]
+    rng = np.random.default_rng(sweep.get('seed', 0))
+    return [{k: sample_value(v, rng) for k, v in space.items()} for _ in range(sweep['num_trials'])]
+
+
+def _dataset_key(cfg):
+    return json.dumps([cfg['train_dataset'], cfg['val_dataset']], sort_keys = True)
+
+
+class ASHA:
+    """ Asynchronous successive halving, shared by the trial processes
+
+    Rungs sit at epochs grace_epochs * reduction_factor ** r. A trial reaching
+    a rung records its score there and keeps training only if the score is
+    in the top 1 / reduction_factor of the scores recorded at that rung so
+    far, so no trial waits for the others.
+
+    Args:
+        manager (multiprocessing.Manager): owner of the shared rung records
+        metric (str, optional): 'hr' or 'ndcg'. Defaults to 'hr'.
+        grace_epochs (int, optional): epochs before the first rung. Defaults to 1.
+        reduction_factor (int, optional): fraction 1 / reduction_factor of trials kept per rung. Defaults to 3.
+    """
+    def __init__(self, manager, metric = 'hr', grace_epochs = 1, reduction_factor = 3):
+        self.metric = metric
+        self.grace_epochs = grace_epochs
+        self.reduction_factor = reduction_factor
+        self.rungs = manager.dict()
+        self.lock = manager.Lock()
+
+    def __call__(self, epoch, hr, ndcg):
+        """ Record a validation, True when the trial should stop """
+        rung = np.log(epoch / self.grace_epochs) / np.log(self.reduction_factor)
+        if epoch < self.grace_epochs or not np.isclose(rung, round(rung)):
+            return False
+        score = hr if self.metric == 'hr' else ndcg
+        with self.lock:
+            scores = self.rungs.get(epoch, []) + [score]
+            self.rungs[epoch] = scores
+        cutoff = np.quantile(scores, 1 - 1 / self.reduction_factor)
+        return score < cutoff
+
+
+def _run_trial(trial, cfg_path, num_threads, early_stop):
+    from train import run
+
+    # one log per trial instead of interleaved progress bars
+    # (stdout/stderr keep their own descriptors of the log once it is closed)
+    log_path = os.path.splitext(cfg_path)[0] + '.log'
+    with open(log_path, 'w') as log:
+        os.dup2(log.fileno(), sys.stdout.fileno())
+        os.dup2(log.fileno(), sys.stderr.fileno())
+    torch.set_num_threads(num_threads)
+
+    with open(cfg_path, 'r') as f:
+        datasets = _shared.get(_dataset_key(json.load(f)))
+    start = time.perf_counter()
+    result = run(cfg_path, datasets = datasets, callback = early_stop)
+    result['seconds'] = time.perf_counter() - start
+    result['trial'] = trial
+    sys.stdout.flush()
+    return result
+
+
+def sweep(sweep_cfg):
+    """Run the trials of a sweep config in a process pool and write the leaderboard
+
+    Args:
+        sweep_cfg (dict): base_config, output_dir, space, search ('grid' or 'random'),
+            num_trials, seed, workers, threads_per_trial, asha ({"metric", "grace_epochs",
+            "reduction_factor"} or null)
+
+    Returns:
+        list: leaderboard rows, best first
+    """
+    with open(sweep_cfg['base_config'], 'r') as f:
+        base = json.load(f)
+    output_dir = sweep_cfg['output_dir']
+    os.makedirs(output_dir, exist_ok = True)
+    workers = sweep_cfg.get('workers', 1)
+    num_threads = sweep_cfg.get('threads_per_trial') or max(1, (os.cpu_count() or 1) // workers)
+    metric = (sweep_cfg.get('asha') or {}).get('metric', base.get('save_mode', 'hr'))
+
+    # one trial config file per trial, each trial a single process
+    trials = []
+    for i, params in enumerate(trial_params(sweep_cfg)):
+        cfg = json.loads(json.dumps(base))
+        for path, value in params.items():
+            set_path(cfg, path, value)
+        cfg['saved_dir'] = output_dir
+        cfg['run_name'] = f'trial{i:03d}'
+        cfg['distributed'] = {'world_size': 1, 'backend': 'gloo'}
+        cfg_path = os.path.join(output_dir, f'trial{i:03d}.json')
+        with open(cfg_path, 'w') as f:
+            json.dump(cfg, f, indent = 2)
+        trials.append((i, params, cfg, cfg_path))
+
+    # the data is parsed (or mapped from its cache) once, before forking
+    from train import build_datasets
+    for _, _, cfg, cfg_path in trials:
+        key = _dataset_key(cfg)
+        if key not in _shared:
+            fix_seed(cfg['seed'])
+            _shared[key] = build_datasets(load_config(cfg_path))
+
+    manager = mp.Manager()
+    early_stop = ASHA(manager, metric, **{k: v for k, v in sweep_cfg['asha'].items() if k != 'metric'}) \
+        if sweep_cfg.get('asha') else None
+
+    leaderboard = []
+    with ProcessPoolExecutor(workers, mp_context = mp.get_context('fork')) as pool:
+        futures = {pool.submit(_run_trial, i, cfg_path, num_threads, early_stop): (i, params)
+                   for i, params, _, cfg_path in trials}
+        for future in as_completed(futures):
+            i, params = futures[future]
+            try:
+                result = future.result()
+                row = {'trial': i, 'params': params, 'hr': result['best_hr'], 'ndcg': result['best_ndcg'],
+                       'epochs': result['epochs'], 'seconds': result['seconds'], 'saved_dir': result['saved_dir']}
+            except Exception as e:
+                row = {'trial': i, 'params': params, 'hr': None, 'ndcg': None, 'error': repr(e)}
+            leaderboard.append(row)
+            leaderboard.sort(key = lambda r: -1 if r[metric] is None else r[metric], reverse = True)
+            with open(os.path.join(output_dir, 'leaderboard.json'), 'w') as f:
+                json.dump({'metric': metric, 'trials': leaderboard}, f, indent = 2)
+            print(f"trial {i:03d} done: {metric} {row[metric]}, {row.get('epochs')} epochs, params {params}")
+    manager.shutdown()
+
+    print(f"{'rank':<6}{'trial':<8}{'HR':>10}{'NDCG':>10}{'epochs':>8}  params")
+    for rank, r in enumerate(leaderboard, 1):
+        hr = f"{r['hr']:.4f}" if r['hr'] is not None else 'error'
+        ndcg = f"{r['ndcg']:.4f}" if r['ndcg'] is not None else ''
+        print(f"{rank:<6}{r['trial']:<8}{hr:>10}{ndcg:>10}{r.get('epochs', ''):>8}  {r['params']}")
+    return leaderboard
+
+
+def main():
+    args = arg_parse()
+    with open(args.cfg, 'r') as f:
+        sweep_cfg = json.load(f)
+    sweep(sweep_cfg)
+
+if __name__ == "__main__":
+    main()
@@ -14,8 +14,15 @@ import torch.nn as nn
 import torch.nn.functional as F
 
 from torch.utils.data import DataLoader
-from torch.cuda.amp import autocast, GradScaler
 from utils import * 
+from data_utils import build_dataloader, format_sampler_stats
+from profiler import TrainProfiler
+from dist_utils import *
+from optimizer import build_optimizer
+from checkpoint import CheckpointWriter
+from precision import Precision, resolve_precision
+from graph import compile_model, is_compiled
+from incremental import incremental_rows, warm_start
 
 from tqdm import tqdm
 from datetime import datetime
@@ -44,30 +51,6 @@ def increment_path(path, exist_ok=False):
         return f"{path}{n}"
 
 
-def save_checkpoint(epoch, model, hr, ndcg, optimizer, saved_dir, scheduler, file_name):
-    """Save checkpoint in save_dir
-
-    Args:
-        epoch (int): number of epoch
-        model (torch model): torch model to save
-        hr (float): hr to save
-        ndcg (float) : ndcg to save
-        optimizer (torch optimizer): optimizer to save
-        saved_dir (str): path to save the file
-        scheduler (torch scheduler): scheduler to save
-        file_name (str): file name
-    """
-    check_point = {'epoch': epoch,
-                   'model': model.state_dict(),
-                   'optimizer_state_dict': optimizer.state_dict(),
-                   'hr': hr,
-                   'ndcg' : ndcg}
-    if scheduler:
-        check_point['scheduler_state_dict'] = scheduler.state_dict()
-    output_path = os.path.join(saved_dir, file_name)
-    torch.save(check_point, output_path)
-
-
 def load_checkpoint(checkpoint_path, model, optimizer, scheduler, mode):
     """Load checkpoint if resume_from is set
 
@@ -82,7 +65,7 @@ def load_checkpoint(checkpoint_path, model, optimizer, scheduler, mode):
         state loaded model, optimizer, scheduler, etc
     """
     # load model if resume_from is set
-    checkpoint = torch.load(checkpoint_path)
+    checkpoint = load_torch_file(checkpoint_path)
     model.load_state_dict(checkpoint['model'])
     if mode =="all":
         optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
@@ -95,80 +78,125 @@ def load_checkpoint(checkpoint_path, model, optimizer, scheduler, mode):
     return model, optimizer, scheduler, start_epoch, start_hr, start_ndcg
 
 
+def negative_scorer(model, device, is_pretrain = False):
+    """Scoring function of the current model for hard negative sampling
+
+    Args:
+        model (torch model): ViT or ONCF being trained
+        device (torch.device): device of the model
+        is_pretrain (bool, optional): score ONCF with the GMF path. Defaults to False.
+
+    Returns:
+        callable: (users (n,), items (n, p)) numpy arrays -> (n, p) numpy scores
+    """
+    kwargs = {'is_pretrain': is_pretrain} if model.model_name == 'ONCF' else {}
+
+    def score(users, items):
+        was_training = model.training
+        model.eval()
+        user_cache = model.encode_users(torch.as_tensor(users, device = device), **kwargs)
+        scores = model.score(user_cache, torch.as_tensor(items, device = device), **kwargs)
+        model.train(was_training)
+        scores = scores['main'] if isinstance(scores, dict) else scores
+        return scores.float().cpu().numpy()
+    return score
+
+
 def train(num_epochs, model, train_loader, val_loader, criterion, optimizer, top_k,
           saved_dir, val_every, save_mode, resume_from, resume_mode, checkpoint_path, 
-          num_to_remain, device, scheduler = None, fp16 = False):
+          num_to_remain, device, scheduler = None, precision = 'fp32', profile = None, callback = None,
+          pretrain_epochs = 3):
+    """Train and validate the model, checkpointing every validation
+
+    precision is 'fp32', 'bf16-cpu' or 'fp16-cuda': the forward pass runs
+    under its autocast, the losses in float32.
+
+    ONCF trains its GMF path for the first pretrain_epochs epochs, then the
+    conv path (0 when fine-tuning a trained model).
 
-    print(f'Start training..')
+    callback, if given, is called as callback(epoch, hr, ndcg) after each
+    validation and stops training when it returns True (e.g. a sweep's
+    early stopping).
+
+    Returns:
+        dict: best_hr, best_ndcg and the number of epochs run
+    """
+
+    main_process = is_main_process()
+    if main_process:
+        print(f'Start training..')
     start_epoch = 0
     best_hr = 0
     best_ndcg = 0
 
-    num_to_remain = 3 # remain 3 files
-
     if resume_from:
         model, optimizer, scheduler, start_epoch, best_hr, best_ndcg = load_checkpoint(checkpoint_path, model, optimizer, scheduler, resume_mode)
     
-    if fp16:
-        print("Mixed precision is applied")
-        scaler = GradScaler()
+    precision = Precision(precision, device)
+    if precision.dtype is not None and main_process:
+        print(f"Mixed precision is applied: {precision.name}")
 
+    # per-phase timing, enabled by the "profile" config, recorded by rank 0
+    profile = dict(profile or {'enabled': False})
+    profile['enabled'] = profile.get('enabled', True) and main_process
+    profiler = TrainProfiler(saved_dir, device, **profile)
+    profiler.attach(model, compiled = is_compiled(model))
+
+    # ViT heads the loss does not use are not computed
+    heads = getattr(criterion, 'outputs', ('main', 'user', 'item'))
+
+    # checkpoints are written in the background, only rank 0 writes files
+    writer = CheckpointWriter(saved_dir, num_to_remain, save_mode) if main_process else None
+
+    stop = False
+    epochs_run = start_epoch
     for epoch in range(start_epoch, num_epochs):
         model.train()
 
         running_loss = 0
         sum_loss = 0
 
-        pbar = tqdm(enumerate(train_loader), total = len(train_loader))
-        train_loader.dataset.ng_sample()
+        with profiler.phase('ng_sample'):
+            # hard negative samplers re-rank their candidates with the current model
+            if hasattr(train_loader.dataset, 'set_scorer'):
+                train_loader.dataset.set_scorer(negative_scorer(model, device, is_pretrain = epoch < pretrain_epochs))
+            train_loader.dataset.ng_sample()
+        pbar = tqdm(enumerate(profiler.iterate(train_loader)), total = len(train_loader), disable = not main_process)
         for step, input in pbar:
-            user = input['user_id'].to(device)
-            if model.model_name == 'ONCF':
-                pos_item = input['item_id'].to(device)
-                neg_item = input['neg_item'].to(device)
-            else:
-                item = input['item_id'].to(device)
-            label = input['target_main'].to(device)
-            
-            user_aux = input['target_user_aux'].to(device)
-            item_aux = input['target_item_aux'].to(device)
-            
-            optimizer.zero_grad()
-            if fp16:
+            with profiler.phase('to_device'):
+                user = input['user_id'].to(device)
                 if model.model_name == 'ONCF':
-                    with autocast():
-                        if epoch < 3:
-                            pos_preds = model(user, pos_item, True)
-                            neg_preds = model(user, neg_item, True)
-                        else:
-                            pos_preds = model(user, pos_item, False)
-                            neg_preds = model(user, neg_item, False)
-                        loss = criterion(pos_preds, neg_preds)
+                    pos_item = input['item_id'].to(device)
+                    neg_item = input['neg_item'].to(device)
                 else:
-                    with autocast():
-                        outputs = model(user, item)
-                        loss = criterion(outputs['main'], outputs['user'], outputs['item'],
-                                        label, user_aux, item_aux)
-
-                scaler.scale(loss).backward()
-                scaler.step(optimizer)
-                scaler.update()
-            else:
-                if model.model_name == 'ONCF':
-                    if epoch < 3:
-                        pos_preds = model(user, pos_item, True)
-                        neg_preds = model(user, neg_item, True)
+                    item = input['item_id'].to(device)
+                label = input['target_main'].to(device)
+                
+                user_aux = input['target_user_aux'].to(device)
+                item_aux = input['target_item_aux'].to(device)
+            
+            optimizer.zero_grad()
+            with profiler.phase('forward'):
+                with precision.autocast():
+                    if model.model_name == 'ONCF':
+                        # GMF pretraining for the first pretrain_epochs epochs
+                        pos_preds, neg_preds = model.score_pairs(user, pos_item, neg_item, epoch < pretrain_epochs)
                     else:
-                        pos_preds = model(user, pos_item, False)
-                        neg_preds = model(user, neg_item, False)
+                        outputs = model(user, item, outputs = heads)
+                # the heads return float32, the losses run outside autocast
+                if model.model_name == 'ONCF':
                     loss = criterion(pos_preds, neg_preds)
                 else:
-                    outputs = model(user, item)
                     loss = criterion(outputs['main'], outputs['user'], outputs['item'],
-                                 label, user_aux, item_aux)
-                loss.backward()
-                optimizer.step()
-
+                                     label, user_aux, item_aux)
+            with profiler.phase('backward'):
+                precision.backward(loss)
+            with profiler.phase('allreduce'):
+                allreduce_gradients(model)
+            with profiler.phase('optimizer'):
+                precision.step(optimizer)
+
+            profiler.step(user.size(0))
             sum_loss += loss.item()
             running_loss = sum_loss / (step + 1)
           
@@ -178,23 +206,20 @@ def train(num_epochs, model, train_loader, val_loader, criterion, optimizer, top
              
         # validation 주기에 따른 loss 출력 및 best model 저장
         if (epoch + 1) % val_every == 0:
-            hr, ndcg = validation(epoch+1, num_epochs, model, val_loader, top_k, device)
+            with profiler.phase('validation'):
+                hr, ndcg = validation(epoch+1, num_epochs, model, val_loader, top_k, device)
             
-            if save_mode == 'hr':
-                if hr > best_hr:
-                    print(f"Best performance at epoch: {epoch + 1}")
-                    print(f"Save model in {saved_dir}")
-                    best_hr = hr
-                    save_checkpoint(epoch, model, best_hr, best_ndcg, optimizer, saved_dir, scheduler, file_name=f"{model.model_name}_{round(best_hr,3)}_{cur_date}.pt")
-            elif save_mode == 'ndcg':
-                if ndcg > best_ndcg:
-                    print(f"Best performance at epoch: {epoch + 1}")
-                    print(f"Save model in {saved_dir}")
-                    best_hr = hr
-                    save_checkpoint(epoch, model, best_hr, best_ndcg, optimizer, saved_dir, scheduler, file_name=f"{model.model_name}_{round(best_ndcg,3)}_{cur_date}.pt")
-
-            if len(os.listdir(saved_dir)) > num_to_remain:
-                remove_old_files(saved_dir, thres=num_to_remain)
+            # every rank holds the same reduced metrics, only rank 0 writes files
+            score = hr if save_mode == 'hr' else ndcg
+            if score > (best_hr if save_mode == 'hr' else best_ndcg) and main_process:
+                print(f"Best performance at epoch: {epoch + 1}")
+            best_hr, best_ndcg = max(best_hr, hr), max(best_ndcg, ndcg)
+            stop = callback is not None and callback(epoch + 1, hr, ndcg)
+
+            # every validated epoch is saved, the writer keeps the num_to_remain best and the latest
+            if main_process:
+                writer.save(epoch, model, hr, ndcg, optimizer, scheduler,
+                            file_name=f"{model.model_name}_{epoch + 1}_{round(score,3)}_{cur_date}.pt")
             
             # lr 조정
             if scheduler:
@@ -206,45 +231,105 @@ def train(num_epochs, model, train_loader, val_loader, criterion, optimizer, top
                 else:
                     scheduler.step()
 
+        sampler_stats = None
+        if hasattr(train_loader.dataset, 'pop_sampler_stats'):
+            sampler_stats = train_loader.dataset.pop_sampler_stats()
+            if main_process and sampler_stats and sampler_stats.get('negatives'):
+                print(format_sampler_stats(sampler_stats))
+        profiler.epoch_end(epoch + 1, sampler = sampler_stats)
+        epochs_run = epoch + 1
+        if stop:
+            if main_process:
+                print(f"Stopped early at epoch: {epoch + 1}")
+            break
 
-def validation(epoch, num_epochs, model, data_loader, top_k, device):
+    profiler.close()
+    if writer:
+        writer.close()
+    return {'best_hr': best_hr, 'best_ndcg': best_ndcg, 'epochs': epochs_run}
+
+
+def evaluate(model, data_loader, top_ks, device):
+    """Rank the ground truth item of every user among its candidates
+
+    Each batch holds whole candidate lists of `data_loader.dataset.num_candidates`
+    rows, ground truth first, so one forward pass scores many users at once.
+    Ranks stay on device until the final reduction.
+
+    Args:
+        model (torch model): ViT or ONCF
+        data_loader (DataLoader): validation loader, batch size a multiple of num_candidates
+        top_ks (int or list): cut-offs to report
+        device (torch.device): device to run on
+
+    Returns:
+        dict: {k: (hr, ndcg)} for every k in top_ks
+    """
+    top_ks = [top_ks] if isinstance(top_ks, int) else list(top_ks)
+    num_candidates = data_loader.dataset.num_candidates
     model.eval()
 
+    ranks = []
     with torch.no_grad():
-
-        HR = []
-        NDCG = []
-    
-        for step, input in tqdm(enumerate(data_loader), total = len(data_loader)):
+        for step, input in tqdm(enumerate(data_loader), total = len(data_loader), disable = not is_main_process()):
             user = input['user_id'].to(device)
             item = input['item_id'].to(device)
-            
-            #user_aux = input['target_user_aux'].to(device)
-            #item_aux = input['target_item_aux'].to(device)
-            
+            assert user.size(0) % num_candidates == 0, \
+                f'validation batch size must be a multiple of {num_candidates} candidates'
+
+            # user side once per candidate list, main head only
+            items = item.view(-1, num_candidates)
+            user_cache = model.encode_users(user.view(-1, num_candidates)[:, 0])
             if model.model_name == 'ONCF':
-                outputs = model(user, item, False)
-                predictions = outputs.view(-1)
+                predictions = model.score(user_cache, items)
             else:
-                outputs = model(user, item)
-                predictions = outputs['main'].view(-1)
+                predictions = model.score(user_cache, items)['main']
 
-            _, indices = torch.topk(predictions, top_k)
-            recommends = torch.take(item, indices).cpu().numpy().tolist()
+            # number of other candidates scored at or above the ground truth, ties count against it
+            ranks.append((predictions[:, 1:] >= predictions[:, :1]).sum(dim = 1))
 
-            gt_item = item[0].item()
-            HR.append(hit(gt_item, recommends))
-            NDCG.append(ndcg(gt_item, recommends))
-        
-        print(f"Epoch [{epoch + 1} / {num_epochs}], HR: {np.mean(HR)}, NDCG: {np.mean(NDCG)}")
-    return np.mean(HR), np.mean(NDCG)
+    ranks = torch.cat(ranks)
+    metrics = rank_metrics(ranks, top_ks)
+    # sharded validation : average over the users of every rank
+    values = all_reduce_mean(torch.stack([m for k in top_ks for m in metrics[k]]), len(ranks))
+    return {k: (values[2 * i].item(), values[2 * i + 1].item()) for i, k in enumerate(top_ks)}
 
 
-def main():
-    args = arg_parse()
+def validation(epoch, num_epochs, model, data_loader, top_k, device):
+    metrics = evaluate(model, data_loader, top_k, device)
+    for k, (hr, ndcg) in metrics.items():
+        if is_main_process():
+            print(f"Epoch [{epoch + 1} / {num_epochs}], HR@{k}: {hr}, NDCG@{k}: {ndcg}")
+    return next(iter(metrics.values()))
+
+
+def build_datasets(cfgs):
+    """ (train, val) datasets of a config """
+    train_dataset_module = getattr(import_module("data_utils"), cfgs.train_dataset.name)
+    train_dataset = train_dataset_module(**cfgs.train_dataset.args._asdict())
+    
+    val_dataset_module = getattr(import_module("data_utils"), cfgs.val_dataset.name)
+    val_dataset = val_dataset_module(**cfgs.val_dataset.args._asdict())
+    return train_dataset, val_dataset
+
 
-    with open(args.cfg, 'r') as f:
-        cfgs = json.load(f, object_hook=lambda d: namedtuple('x', d.keys())(*d.values()))
+def run(cfg_path, rank = 0, world_size = 1, datasets = None, callback = None):
+    """Train the run described by a config file
+
+    Args:
+        cfg_path (str): train config json
+        rank (int, optional): process rank for distributed training. Defaults to 0.
+        world_size (int, optional): number of processes. Defaults to 1.
+        datasets (tuple, optional): (train, val) datasets already built from this config. Defaults to None.
+        callback (callable, optional): validation callback, see train. Defaults to None.
+
+    Returns:
+        dict: result of train plus the saved_dir of the run
+    """
+    cfgs = load_config(cfg_path)
+    if world_size > 1:
+        backend = cfgs.distributed.backend if hasattr(cfgs, 'distributed') else 'gloo'
+        init_distributed(rank, world_size, backend)
 
     # fix seed
     fix_seed(cfgs.seed)
@@ -252,17 +337,34 @@ def main():
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
     # dataset & data loader
-    train_dataset_module = getattr(import_module("data_utils"), cfgs.train_dataset.name)
-    train_dataset = train_dataset_module(**cfgs.train_dataset.args._asdict())
-    train_dataloader = DataLoader(train_dataset, **cfgs.train_dataloader.args._asdict())
-    
-    val_dataset_module = getattr(import_module("data_utils"), cfgs.val_dataset.name)
-    val_dataset = val_dataset_module(**cfgs.val_dataset.args._asdict())
-    val_dataloader = DataLoader(val_dataset, **cfgs.val_dataloader.args._asdict())
+    train_dataset, val_dataset = datasets or build_datasets(cfgs)
+    # BPRLoss pairs each positive with its own negatives, the labelled ViT losses take one sample per row
+    pairwise = getattr(train_dataset, 'pairwise', False)
+    if cfgs.model.name == 'ONCF':
+        assert pairwise or not train_dataset.num_ng, 'ONCF with num_ng > 0 needs "pairwise": true in train_dataset.args'
+    else:
+        assert not pairwise, f'{cfgs.model.name} trains on labelled rows, set "pairwise": false'
+
+    # incremental: new interactions since a previous run plus a replay sample of the old ones
+    incremental = hasattr(cfgs, 'incremental') and cfgs.incremental.enabled
+    if incremental:
+        assert hasattr(train_dataset, 'select'), f'{cfgs.train_dataset.name} does not support incremental training'
+        train_dataset.select(incremental_rows(train_dataset, cfgs.incremental))
+
+    # each rank trains and validates on its own shard
+    if world_size > 1:
+        train_dataset.shard(rank, world_size)
+        val_dataset.shard(rank, world_size)
+    train_dataloader = build_dataloader(train_dataset, **cfgs.train_dataloader.args._asdict())
+    val_dataloader = build_dataloader(val_dataset, **cfgs.val_dataloader.args._asdict())
 
     # model
     model_module = getattr(import_module("model"), cfgs.model.name)
     model = model_module(**cfgs.model.args._asdict()).to(device)
+    if incremental:
+        # tables grown to the current user/item counts, the rest from the previous run
+        warm_start(model, cfgs.incremental)
+    broadcast_parameters(model)
 
     # criterion
     if hasattr(import_module("criterions"), cfgs.criterion.name):
@@ -270,30 +372,44 @@ def main():
     else:
         criterion_module = getattr(import_module("torch.nn"), cfgs.criterion.name)
     criterion = criterion_module(**cfgs.criterion.args._asdict())
+    # training backpropagates a single loss value
+    assert getattr(criterion, 'reduction', 'mean') != 'none', \
+        'train.py needs a scalar loss, set the criterion reduction to "mean" or "sum"'
+    precision = resolve_precision(cfgs, device)
+
+    # compiled training and scoring methods, eager if compilation fails or disagrees
+    if hasattr(cfgs, 'compile') and cfgs.compile.enabled:
+        compile_args = {k: v for k, v in cfgs.compile._asdict().items() if k != 'enabled'}
+        compile_model(model, cfgs.train_dataloader.args.batch_size, val_dataset.num_candidates,
+                      max(1, cfgs.val_dataloader.args.batch_size // val_dataset.num_candidates),
+                      heads = getattr(criterion, 'outputs', ('main', 'user', 'item')),
+                      num_neg = train_dataset.num_ng if pairwise else 1,
+                      autocast = Precision(precision, device).autocast, device = device, **compile_args)
 
     # optimizer
-    optimizer_module = getattr(import_module("torch.optim"), cfgs.optimizer.name)
-    optimizer = optimizer_module(model.parameters(), **cfgs.optimizer.args._asdict())
+    optimizer = build_optimizer(model, cfgs.optimizer)
 
     # scheduler
     try:
-        if hasattr(import_module("scheduler"), cfgs.scheduler.name):
+        try:
             scheduler_module = getattr(import_module("scheduler"), cfgs.scheduler.name)
-            scheduler = scheduler_module(optimizer, **cfgs.scheduler.args._asdict())
-        else:
+        except (ImportError, AttributeError):
             scheduler_module = getattr(import_module("torch.optim.lr_scheduler"), cfgs.scheduler.name)
-            scheduler = scheduler_module(optimizer, **cfgs.scheduler.args._asdict())
+        scheduler = scheduler_module(optimizer, **cfgs.scheduler.args._asdict())
     except AttributeError :
             print('There is no Scheduler!')
             scheduler = None
     
     # get a path to save checkpoints and config
-    saved_dir = increment_path(f"{cfgs.saved_dir}/{cfgs.run_name}")
-    if not os.path.exists(saved_dir):
-        os.makedirs(saved_dir)
+    saved_dir = None
+    if is_main_process():
+        saved_dir = increment_path(f"{cfgs.saved_dir}/{cfgs.run_name}")
+        if not os.path.exists(saved_dir):
+            os.makedirs(saved_dir)
 
-    # save a config.json before training
-    shutil.copy(args.cfg, f"{saved_dir}/config.json")
+        # save a config.json before training
+        shutil.copy(cfg_path, f"{saved_dir}/config.json")
+    saved_dir = broadcast_object(saved_dir)
 
     # call train
     train_args = {
@@ -313,10 +429,38 @@ def main():
         'device': device,
         'scheduler': scheduler,
         'top_k' : cfgs.top_k,
-        'fp16': cfgs.fp16
+        'precision': precision,
+        'profile': cfgs.profile._asdict() if hasattr(cfgs, 'profile') else None,
+        'callback': callback,
+        'pretrain_epochs': 0 if incremental else 3
     }
 
-    train(**train_args)
+    result = train(**train_args)
+    cleanup()
+    result['saved_dir'] = saved_dir
+    return result
+
+
+def _spawn_worker(rank, cfg_path, world_size):
+    run(cfg_path, rank, world_size)
+
+
+def main():
+    args = arg_parse()
+    cfgs = load_config(args.cfg)
+
+    if 'RANK' in os.environ:
+        # launched by torchrun
+        run(args.cfg, int(os.environ['RANK']), int(os.environ['WORLD_SIZE']))
+        return
+
+    world_size = cfgs.distributed.world_size if hasattr(cfgs, 'distributed') else 1
+    if world_size > 1:
+        os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+        os.environ.setdefault('MASTER_PORT', str(free_port()))
+        torch.multiprocessing.spawn(_spawn_worker, args = (args.cfg, world_size), nprocs = world_size)
+    else:
+        run(args.cfg)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,11 +1,13 @@
 import os
 import re
 import glob
+import json
 import torch
 import random
 import argparse
 import numpy as np
 from pathlib import Path
+from collections import namedtuple
 
 
 def arg_parse():
@@ -19,6 +21,26 @@ def arg_parse():
     return args
 
 
+def load_config(path):
+    """
+    load a json config with attribute access (cfgs.model.args, ...)
+    """
+    with open(path, 'r') as f:
+        cfgs = json.load(f, object_hook=lambda d: namedtuple('x', d.keys())(*d.values()))
+    return cfgs
+
+
+def load_torch_file(path, map_location=None):
+    """
+    torch.load for checkpoints written by this project, which also hold
+    numpy scalars and other non-tensor metadata
+    """
+    try:
+        return torch.load(path, map_location=map_location, weights_only=False)
+    except TypeError:  # torch < 1.13 has no weights_only
+        return torch.load(path, map_location=map_location)
+
+
 def fix_seed(random_seed):
     """
     fix seed to control any randomness from a code 
@@ -33,32 +55,19 @@ def fix_seed(random_seed):
     random.seed(random_seed)
 
 
-def remove_old_files(target_dir, thres = 3):
+def rank_metrics(ranks, top_ks):
     """
-    remove old pt files from a target directory
+    HR@k and NDCG@k from the 0-based rank of each user's ground truth item
     - Args
-        target_dir: a directory to remove files from
-        thres: number of files to be remained
+        ranks: (num_users,) tensor of ranks
+        top_ks: list of cut-offs
+    - Returns
+        {k: (hr, ndcg)} of 0-dim tensors on the device of ranks
     """
-    files = sorted(os.listdir(target_dir), key=lambda x: os.path.getctime(os.path.join(target_dir, x)))
-    files = [os.path.join(target_dir, f) for f in files if f.endswith(".pt")]
-
-    if len(files) <= 1:
-        print("No Files to Remove")
-        return 
-
-    for i in range(0, len(files)-thres):
-        os.remove(files[i])
-
-
-def hit(gt_item, pred_items):
-	if gt_item in pred_items:
-		return 1
-	return 0
-
-
-def ndcg(gt_item, pred_items):
-	if gt_item in pred_items:
-		index = pred_items.index(gt_item)
-		return np.reciprocal(np.log2(index+2))
-	return 0
\ No newline at end of file
+    ranks = ranks.float()
+    gains = torch.reciprocal(torch.log2(ranks + 2))
+    metrics = {}
+    for k in top_ks:
+        hit_k = ranks < k
+        metrics[k] = (hit_k.float().mean(), torch.where(hit_k, gains, torch.zeros_like(gains)).mean())
+    return metrics
\ No newline at end of file